@@ -5,7 +5,8 @@ from accounts.models import (
     ContactInfo,
     AddressInfo,
     AvatarInfo,
-    CashoutMethod
+    CashoutMethod,
+    ReferralCount,
 )
 
 admin.site.register(Account)
@@ -14,3 +15,4 @@ admin.site.register(ContactInfo)
 admin.site.register(AddressInfo)
 admin.site.register(AvatarInfo)
 admin.site.register(CashoutMethod)
+admin.site.register(ReferralCount)
@@ -1,8 +1,12 @@
 from rest_framework import status, views, permissions
 from rest_framework.viewsets import ModelViewSet
 from rest_framework.response import Response
+from rest_framework.exceptions import ValidationError
+from django.conf import settings
 from django.core.signing import Signer, BadSignature
-from django.db.models import Q, Prefetch, F, Value as V, query, Count, Sum, Case, When, DecimalField
+from django.db import transaction
+from django.http import StreamingHttpResponse
+from django.db.models import Q, Prefetch, F, Value as V, query, Count, Sum, Case, When, DecimalField, OuterRef, Subquery
 from django.db.models.functions import Concat, Coalesce
 from django.shortcuts import get_object_or_404
 from vanguard.permissions import IsDeveloperUser, IsAdminUser, IsStaffUser, IsMemberUser
@@ -20,9 +24,13 @@ from accounts.serializers import (
     UserAccountAvatarSerializer,
     UserAccountSerializer,
 )
-from accounts.models import Account, CashoutMethod
-from accounts.enums import ParentSide
+from accounts.models import Account, CashoutMethod, ReferralCount
+from accounts.enums import GenealogyMode, ParentSide
 from accounts.services import (
+    get_genealogy_depth,
+    get_genealogy_tree,
+    get_leaderboard_period_param,
+    get_leaderboard_size,
     is_valid_uuid,
     process_create_account_request,
     activate_account,
@@ -32,14 +40,15 @@ from accounts.services import (
     update_user_status,
     verify_account_creation,
     redact_string,
+    stream_genealogy,
     verify_account_name,
     verify_parent_account,
     verify_parent_side,
     verify_sponsor_account,
 )
-from core.models import Code
-from core.enums import ActivityStatus, CodeStatus, WalletType, ActivityType, CodeType
-from core.services import comp_plan, create_leadership_bonus_activity, verify_code_details
+from core.models import Code, LeaderboardEntry, CASHOUT_WALLETS
+from core.enums import ActivityStatus, CodeStatus, WalletType, ActivityType, CodeType, CompPlanJobType
+from core.services import comp_plan, create_leadership_bonus_activity, enqueue_comp_plan_job, verify_code_details
 from users.models import User
 
 
@@ -115,7 +124,17 @@ class AccountReferralsViewSet(ModelViewSet):
     http_method_names = ["get"]
 
     def get_queryset(self):
-        queryset = Account.objects.exclude(is_deleted=True).all()
+        referral_counts = (
+            ReferralCount.objects.filter(sponsor=OuterRef("pk"))
+            .values("sponsor")
+            .annotate(total=Sum(F("count") + F("free_slot_count")))
+            .values("total")
+        )
+        queryset = (
+            Account.objects.exclude(is_deleted=True)
+            .annotate(referral_count=Coalesce(Subquery(referral_counts), 0))
+            .all()
+        )
         if queryset.exists():
             return queryset
 
@@ -127,30 +146,23 @@ class TopAccountWalletViewSet(ModelViewSet):
     http_method_names = ["get"]
 
     def get_queryset(self):
+        # Ranked by net balance outside the company wallet, every activity there less the cashouts that were not
+        # denied, from the leaderboard, optionally of one cashout wallet (wallet) and one month (period=current or
+        # YYYY-MM)
+        wallet = self.request.query_params.get("wallet", None)
+        if wallet not in CASHOUT_WALLETS:
+            wallet = LeaderboardEntry.ALL_WALLETS
+        period = get_leaderboard_period_param(self.request)
+        if period is None:
+            raise ValidationError({"message": "Invalid period, expected current or YYYY-MM."})
         queryset = (
             Account.objects.exclude(is_deleted=True)
-            .annotate(
-                wallet_amount=Coalesce(
-                    Sum(
-                        Case(
-                            When(
-                                Q(activity__activity_type=ActivityType.CASHOUT)
-                                & ~Q(activity__status=ActivityStatus.DENIED),
-                                then=0 - F("activity__activity_amount"),
-                            ),
-                            When(
-                                ~Q(activity__activity_type=ActivityType.CASHOUT)
-                                & ~Q(activity__wallet=WalletType.C_WALLET),
-                                then=F("activity__activity_amount"),
-                            ),
-                        )
-                    ),
-                    0,
-                    output_field=DecimalField(),
-                )
+            .filter(
+                leaderboard_entries__wallet=wallet,
+                leaderboard_entries__period=period,
             )
-            .all()
-            .order_by("-wallet_amount")[:5]
+            .annotate(wallet_amount=F("leaderboard_entries__amount"))
+            .order_by("-wallet_amount")[: get_leaderboard_size(self.request)]
         )
         if queryset.exists():
             return queryset
@@ -172,47 +184,28 @@ class GenealogyAccountAdminViewSet(ModelViewSet):
             account = get_object_or_404(Account, id=account_id.lstrip("0"))
 
         if account is not None:
-            queryset = Account.objects.prefetch_related(
-                Prefetch(
-                    "children",
-                    queryset=Account.objects.prefetch_related(
-                        Prefetch(
-                            "children",
-                            queryset=Account.objects.prefetch_related(
-                                Prefetch(
-                                    "children",
-                                    queryset=Account.objects.prefetch_related(
-                                        Prefetch(
-                                            "children",
-                                            queryset=Account.objects.prefetch_related(
-                                                Prefetch(
-                                                    "children",
-                                                    queryset=Account.objects.order_by("parent_side").all(),
-                                                )
-                                            )
-                                            .order_by("parent_side")
-                                            .all(),
-                                        )
-                                    )
-                                    .order_by("parent_side")
-                                    .all(),
-                                )
-                            )
-                            .order_by("parent_side")
-                            .all(),
-                        )
-                    )
-                    .order_by("parent_side")
-                    .all(),
-                ),
-            ).filter(id=account.pk)
-
-            for member in queryset:
-                member.all_left_children_count = len(member.get_all_children_side(parent_side=ParentSide.LEFT))
-                member.all_right_children_count = len(member.get_all_children_side(parent_side=ParentSide.RIGHT))
+            queryset = Account.objects.filter(id=account.pk)
 
             return queryset
 
+    def list(self, request, *args, **kwargs):
+        account_id = request.query_params.get("account_id", None)
+        if not account_id:
+            return Response(data=[], status=status.HTTP_200_OK)
+
+        depth = get_genealogy_depth(request)
+        members = self.get_queryset() or []
+
+        if request.query_params.get("mode", None) == GenealogyMode.FLAT:
+            return StreamingHttpResponse(
+                stream_genealogy(members, depth, parent_id=account_id, request=request),
+                content_type="application/json",
+            )
+
+        data = [get_genealogy_tree(member, depth, parent_id=account_id, request=request) for member in members]
+
+        return Response(data=data, status=status.HTTP_200_OK)
+
 
 class GenealogyAccountMemberViewSet(ModelViewSet):
     queryset = Account.objects.all()
@@ -232,50 +225,29 @@ class GenealogyAccountMemberViewSet(ModelViewSet):
 
         if account is not None:
             user_account = Account.objects.get(user=self.request.user)
-            children = user_account.get_all_children()
-
-            if account in children or account == user_account:
-                queryset = Account.objects.prefetch_related(
-                    Prefetch(
-                        "children",
-                        queryset=Account.objects.prefetch_related(
-                            Prefetch(
-                                "children",
-                                queryset=Account.objects.prefetch_related(
-                                    Prefetch(
-                                        "children",
-                                        queryset=Account.objects.prefetch_related(
-                                            Prefetch(
-                                                "children",
-                                                queryset=Account.objects.prefetch_related(
-                                                    Prefetch(
-                                                        "children",
-                                                        queryset=Account.objects.order_by("parent_side").all(),
-                                                    )
-                                                )
-                                                .order_by("parent_side")
-                                                .all(),
-                                            )
-                                        )
-                                        .order_by("parent_side")
-                                        .all(),
-                                    )
-                                )
-                                .order_by("parent_side")
-                                .all(),
-                            )
-                        )
-                        .order_by("parent_side")
-                        .all(),
-                    ),
-                ).filter(id=account.pk)
-
-                for member in queryset:
-                    member.all_left_children_count = len(member.get_all_children_side(parent_side=ParentSide.LEFT))
-                    member.all_right_children_count = len(member.get_all_children_side(parent_side=ParentSide.RIGHT))
+
+            if account == user_account or account.is_downline_of(user_account):
+                queryset = Account.objects.filter(id=account.pk)
 
                 return queryset
 
+    def list(self, request, *args, **kwargs):
+        user_account = request.user.account_user.all().first()
+        depth = get_genealogy_depth(request)
+        members = self.get_queryset() or []
+
+        if request.query_params.get("mode", None) == GenealogyMode.FLAT:
+            return StreamingHttpResponse(
+                stream_genealogy(members, depth, parent_id=user_account.account_id, request=request),
+                content_type="application/json",
+            )
+
+        data = [
+            get_genealogy_tree(member, depth, parent_id=user_account.account_id, request=request) for member in members
+        ]
+
+        return Response(data=data, status=status.HTTP_200_OK)
+
 
 class BinaryAccountProfileViewSet(ModelViewSet):
     queryset = Account.objects.all()
@@ -295,10 +267,6 @@ class BinaryAccountProfileViewSet(ModelViewSet):
         if account_id is not None:
             queryset = queryset.filter(account_id=account_id)
 
-            for member in queryset:
-                member.all_left_children_count = len(member.get_all_children_side(parent_side=ParentSide.LEFT))
-                member.all_right_children_count = len(member.get_all_children_side(parent_side=ParentSide.RIGHT))
-
             return queryset
 
 
@@ -319,6 +287,20 @@ class CreateAccountView(views.APIView):
 
             serializer = AccountSerializer(data=processed_request)
             if serializer.is_valid():
+                if settings.COMP_PLAN_ASYNC:
+                    with transaction.atomic():
+                        new_member = serializer.save()
+                        job = enqueue_comp_plan_job(request, new_member, package, code, CompPlanJobType.CREATE)
+                        code.update_status(Account)
+                    # Only signed in callers can poll the job, anonymous registrations are not given its id
+                    data = {"message": "Account created."}
+                    if request.user.is_authenticated:
+                        data["job_id"] = job.job_id
+                    return Response(
+                        data=data,
+                        status=status.HTTP_202_ACCEPTED,
+                    )
+
                 new_member = serializer.save()
                 is_valid = comp_plan(request, new_member, package, code)
                 if is_valid:
@@ -558,6 +540,18 @@ class UpgradeAccountView(views.APIView):
         data = {"activation_code": activation_code.pk, "package": package.pk}
         serializer = AccountSerializer(account, data=data, partial=True)
         if serializer.is_valid():
+            if settings.COMP_PLAN_ASYNC:
+                with transaction.atomic():
+                    upgraded_member = serializer.save()
+                    job = enqueue_comp_plan_job(
+                        request, upgraded_member, package, activation_code, CompPlanJobType.UPGRADE
+                    )
+                    activation_code.update_status(Account)
+                return Response(
+                    data={"message": "Account upgraded.", "job_id": job.job_id},
+                    status=status.HTTP_202_ACCEPTED,
+                )
+
             upgraded_member = serializer.save()
             is_valid = comp_plan(request, upgraded_member, package, activation_code)
             if is_valid:
@@ -18,3 +18,8 @@ class ParentSide(models.TextChoices):
 class Gender(models.TextChoices):
     MALE = "MALE", _("Male")
     FEMALE = "FEMALE", _("Female")
+
+
+class GenealogyMode(models.TextChoices):
+    NESTED = "nested", _("Nested")
+    FLAT = "flat", _("Flat")
@@ -0,0 +1,250 @@
+import contextlib
+import datetime
+import random
+import uuid
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+from accounts.enums import AccountStatus, ParentSide
+from accounts.models import Account
+from core.enums import CodeStatus, CodeType
+from core.models import Activity, Code, Package
+from core.services import CompPlanReplay, rollup_daily_activities
+
+
+def parse_package_mix(value=None):
+    package_mix = {}
+    for part in value.split(","):
+        package_id, separator, weight = part.partition("=")
+        if not separator:
+            raise CommandError("Expected PACKAGE_ID=WEIGHT, got %s." % part)
+        package_mix[int(package_id)] = float(weight)
+    return package_mix
+
+
+@contextlib.contextmanager
+def explicit_timestamps(*models):
+    # Generated rows carry their own created/modified times instead of the time of the insert. The fields are
+    # switched for the whole process, so the command must not share one with request handling threads
+    fields = [
+        field
+        for model in models
+        for field in model._meta.fields
+        if getattr(field, "auto_now", False) or getattr(field, "auto_now_add", False)
+    ]
+    flags = [(field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, (auto_now, auto_now_add) in zip(fields, flags):
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+class NetworkGenerator:
+    """
+    Grows a binary network one registration at a time. Each new member picks a sponsor, a recent one with
+    probability locality, and is placed either at the far end of the sponsor's leg on the chosen side
+    (spillover), which makes deep lopsided legs, or in a random open slot anywhere in the tree.
+    """
+
+    def __init__(self, seed=None, skew=None, spillover=None, locality=None, free_slot=None, package_mix=None):
+        self.random = random.Random(seed)
+        self.skew = skew
+        self.spillover = spillover
+        self.locality = locality
+        self.free_slot = free_slot
+        self.package_ids = list(package_mix.keys())
+        self.package_weights = list(package_mix.values())
+        self.children = {ParentSide.LEFT: [], ParentSide.RIGHT: []}
+        self.leg_ends = {ParentSide.LEFT: [], ParentSide.RIGHT: []}
+        self.open_slots = []
+        self.open_slot_positions = {}
+
+    def add_open_slot(self, slot=None):
+        self.open_slot_positions[slot] = len(self.open_slots)
+        self.open_slots.append(slot)
+
+    def remove_open_slot(self, slot=None):
+        position = self.open_slot_positions.pop(slot)
+        last_slot = self.open_slots.pop()
+        if last_slot != slot:
+            self.open_slots[position] = last_slot
+            self.open_slot_positions[last_slot] = position
+
+    def get_leg_end(self, position=None, side=None):
+        children = self.children[side]
+        leg_end = self.leg_ends[side][position]
+        while children[leg_end] >= 0:
+            leg_end = children[leg_end]
+        self.leg_ends[side][position] = leg_end
+        return leg_end
+
+    def add_member(self):
+        position = len(self.children[ParentSide.LEFT])
+        for side in (ParentSide.LEFT, ParentSide.RIGHT):
+            self.children[side].append(-1)
+            self.leg_ends[side].append(position)
+        package_id = self.random.choices(self.package_ids, self.package_weights)[0]
+        code_type = CodeType.FREE_SLOT if self.random.random() < self.free_slot else CodeType.ACTIVATION
+
+        if position == 0:
+            sponsor, parent, side = -1, -1, None
+        else:
+            if self.random.random() < self.locality:
+                sponsor = self.random.randrange(max(0, position - 50), position)
+            else:
+                sponsor = self.random.randrange(position)
+
+            if self.random.random() < self.spillover:
+                side = ParentSide.LEFT if self.random.random() < self.skew else ParentSide.RIGHT
+                parent = self.get_leg_end(sponsor, side)
+            else:
+                parent, side = self.random.choice(self.open_slots)
+            self.children[side][parent] = position
+            self.remove_open_slot((parent, side))
+
+        for open_side in (ParentSide.LEFT, ParentSide.RIGHT):
+            self.add_open_slot((position, open_side))
+
+        return sponsor, parent, side, package_id, code_type
+
+
+class Command(BaseCommand):
+    help = (
+        "Generates a deterministic synthetic network of accounts, their activation codes and the comp plan ledger "
+        "they would have produced, for load testing and benchmarks"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("size", type=int, help="Accounts to generate")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--skew", type=float, default=0.5, help="Chance a spillover goes to the left leg")
+        parser.add_argument(
+            "--spillover", type=float, default=0.7, help="Chance a member goes to the end of a sponsor's leg"
+        )
+        parser.add_argument("--locality", type=float, default=0.8, help="Chance the sponsor is a recent member")
+        parser.add_argument("--free-slot", type=float, default=0.05, help="Share of FREE_SLOT registrations")
+        parser.add_argument("--package-mix", help="PACKAGE_ID=WEIGHT,... (defaults to every package equally)")
+        parser.add_argument("--start", type=datetime.date.fromisoformat, help="Date of the first registration")
+        parser.add_argument("--days", type=int, default=365, help="Days the registrations are spread over")
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        size = options["size"]
+        batch_size = options["batch_size"]
+        if options["package_mix"]:
+            package_mix = parse_package_mix(options["package_mix"])
+        else:
+            package_ids = Package.objects.filter(is_franchise=False).values_list("id", flat=True)
+            package_mix = {package_id: 1 for package_id in package_ids}
+        packages = Package.objects.in_bulk(list(package_mix))
+        if not packages or len(packages) != len(package_mix):
+            raise CommandError("Unknown or missing packages.")
+
+        generator = NetworkGenerator(
+            options["seed"],
+            options["skew"],
+            options["spillover"],
+            options["locality"],
+            options["free_slot"],
+            package_mix,
+        )
+        start = options["start"] or timezone.localdate() - datetime.timedelta(days=options["days"])
+        started = timezone.make_aware(datetime.datetime.combine(start, datetime.time()))
+        interval = datetime.timedelta(days=options["days"]) / max(size, 1)
+
+        first_account_id = (Account.objects.aggregate(id=Max("id"))["id"] or 0) + 1
+        first_code_id = (Code.objects.aggregate(id=Max("id"))["id"] or 0) + 1
+        replay = CompPlanReplay(self.write_activity)
+        replay.next_activity_id = (Activity.objects.aggregate(id=Max("id"))["id"] or 0) + 1
+        self.activities = []
+        self.activity_count = 0
+        self.batch_size = batch_size
+
+        with transaction.atomic(), explicit_timestamps(Account, Code, Activity):
+            accounts = []
+            codes = []
+            for position in range(size):
+                sponsor, parent, side, package_id, code_type = generator.add_member()
+                account_id = first_account_id + position
+                parent_id = first_account_id + parent if parent >= 0 else None
+                referrer_id = first_account_id + sponsor if sponsor >= 0 else None
+                created = started + interval * position
+
+                codes.append(
+                    Code(
+                        id=first_code_id + position,
+                        code="".join(generator.random.choices("ABCDEFGHJKLMNPQRSTUVWXYZ23456789", k=12)),
+                        package_id=package_id,
+                        code_type=code_type,
+                        status=CodeStatus.USED,
+                        owner_id=referrer_id,
+                        created=created,
+                        modified=created,
+                    )
+                )
+                accounts.append(
+                    Account(
+                        id=account_id,
+                        account_id=uuid.UUID(int=generator.random.getrandbits(128), version=4),
+                        parent_id=parent_id,
+                        parent_side=side,
+                        activation_code_id=first_code_id + position,
+                        package_id=package_id,
+                        referrer_id=referrer_id,
+                        first_name="Member",
+                        last_name=str(account_id),
+                        account_status=AccountStatus.ACTIVE,
+                        created=created,
+                        modified=created,
+                    )
+                )
+                replay_position = replay.add_account(account_id, parent_id, side, referrer_id, package_id)
+                replay.events.append((created, 0, account_id, replay_position, package_id, code_type))
+
+                if len(accounts) >= batch_size:
+                    self.save_accounts(accounts, codes)
+
+            self.save_accounts(accounts, codes)
+            replay.run_events()
+            self.save_activities()
+
+            with connection.cursor() as cursor:
+                for sql in connection.ops.sequence_reset_sql(no_style(), [Account, Code, Activity]):
+                    cursor.execute(sql)
+
+            for command, command_options in [
+                ("rebuild_genealogy", {}),
+                ("rebuild_pv_balances", {}),
+                ("rebuild_daily_sales_matches", {}),
+                ("reconcile_fifth_pairs", {"fix": True}),
+                ("rebuild_referral_counts", {}),
+                ("rebuild_wallet_balances", {}),
+                ("rebuild_leaderboard", {}),
+            ]:
+                call_command(command, batch_size=batch_size, stdout=self.stdout, **command_options)
+            rollup_daily_activities(start=start)
+
+        self.stdout.write(self.style.SUCCESS("Generated %s accounts and %s activities." % (size, self.activity_count)))
+
+    def save_accounts(self, accounts=None, codes=None):
+        # Codes and accounts reference each other, the foreign keys are only checked at commit
+        Code.objects.bulk_create(codes)
+        Account.objects.bulk_create(accounts)
+        accounts.clear()
+        codes.clear()
+
+    def write_activity(self, activity=None):
+        self.activities.append(activity)
+        if len(self.activities) >= self.batch_size:
+            self.save_activities()
+
+    def save_activities(self):
+        Activity.objects.bulk_create(self.activities)
+        self.activity_count += len(self.activities)
+        self.activities.clear()
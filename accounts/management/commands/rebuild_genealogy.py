@@ -0,0 +1,81 @@
+from collections import defaultdict
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from accounts.enums import ParentSide
+from accounts.models import Account, ANCESTRY_SEPARATOR, ANCESTRY_SIDE_CODES, ANCESTRY_UNKNOWN_SIDE
+
+
+class Command(BaseCommand):
+    help = "Recomputes the materialized placement and sponsor ancestry and left/right downline counts of every Account"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        children = defaultdict(list)
+        roots = []
+        referrals = defaultdict(list)
+        top_sponsors = []
+        for pk, parent_id, parent_side, referrer_id in Account.objects.order_by().values_list(
+            "id", "parent_id", "parent_side", "referrer_id"
+        ):
+            if parent_id is None:
+                roots.append(pk)
+            else:
+                children[parent_id].append((pk, parent_side))
+            if referrer_id is None:
+                top_sponsors.append(pk)
+            else:
+                referrals[referrer_id].append(pk)
+
+        placements = []
+        with transaction.atomic():
+            # Walk the tree level by level so only one generation of paths is held in memory
+            level = 0
+            frontier = [(pk, "") for pk in roots]
+            while frontier:
+                accounts = [Account(id=pk, ancestry=ancestry, placement_level=level) for pk, ancestry in frontier]
+                Account.objects.bulk_update(accounts, ["ancestry", "placement_level"], batch_size=batch_size)
+
+                next_frontier = []
+                for pk, ancestry in frontier:
+                    for child_pk, side in children.pop(pk, []):
+                        placements.append((child_pk, pk, side))
+                        side_code = ANCESTRY_SIDE_CODES.get(side, ANCESTRY_UNKNOWN_SIDE)
+                        next_frontier.append((child_pk, "%s%s%s%s" % (ancestry, pk, side_code, ANCESTRY_SEPARATOR)))
+                frontier = next_frontier
+                level += 1
+
+            # Placements are in breadth-first order, so walking them backwards visits every subtree
+            # before its parent
+            subtree_sizes = defaultdict(lambda: 1)
+            left_counts = defaultdict(int)
+            right_counts = defaultdict(int)
+            for pk, parent_id, side in reversed(placements):
+                match side:
+                    case ParentSide.LEFT:
+                        left_counts[parent_id] += subtree_sizes[pk]
+                    case ParentSide.RIGHT:
+                        right_counts[parent_id] += subtree_sizes[pk]
+                subtree_sizes[parent_id] += subtree_sizes[pk]
+
+            frontier = [(pk, "") for pk in top_sponsors]
+            while frontier:
+                accounts = [Account(id=pk, sponsor_ancestry=sponsor_ancestry) for pk, sponsor_ancestry in frontier]
+                Account.objects.bulk_update(accounts, ["sponsor_ancestry"], batch_size=batch_size)
+                frontier = [
+                    (referral_pk, "%s%s%s" % (sponsor_ancestry, pk, ANCESTRY_SEPARATOR))
+                    for pk, sponsor_ancestry in frontier
+                    for referral_pk in referrals.pop(pk, [])
+                ]
+
+            accounts = [
+                Account(id=pk, all_left_children_count=left_counts[pk], all_right_children_count=right_counts[pk])
+                for pk in roots + [placement[0] for placement in placements]
+            ]
+            Account.objects.bulk_update(
+                accounts, ["all_left_children_count", "all_right_children_count"], batch_size=batch_size
+            )
+
+        self.stdout.write(self.style.SUCCESS("Rebuilt genealogy of %s accounts." % len(accounts)))
@@ -0,0 +1,36 @@
+from django.db import transaction
+from django.db.models import Q, Count
+from django.core.management.base import BaseCommand
+from accounts.models import Account, ReferralCount
+from core.enums import CodeType
+
+
+class Command(BaseCommand):
+    help = "Recomputes the per-package referral counts of every sponsor Account"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        is_free_slot = Q(activation_code__code_type=CodeType.FREE_SLOT)
+        counts = (
+            Account.objects.filter(referrer__isnull=False)
+            .values("referrer", "package")
+            .annotate(count=Count("id", filter=~is_free_slot), free_slot_count=Count("id", filter=is_free_slot))
+            .order_by()
+        )
+        referral_counts = [
+            ReferralCount(
+                sponsor_id=count["referrer"],
+                package_id=count["package"],
+                count=count["count"],
+                free_slot_count=count["free_slot_count"],
+            )
+            for count in counts
+        ]
+
+        with transaction.atomic():
+            ReferralCount.objects.all().delete()
+            ReferralCount.objects.bulk_create(referral_counts, batch_size=options["batch_size"])
+
+        self.stdout.write(self.style.SUCCESS("Rebuilt %s referral counts." % len(referral_counts)))
@@ -1,13 +1,19 @@
 import uuid
 from django.db import models
 from django.utils import timezone
-from django.db.models.functions import TruncDate
+from django.db.models.functions import Greatest, TruncDate
 from tzlocal import get_localzone
 from dateutil.relativedelta import relativedelta
 from accounts.enums import AccountStatus, Gender, ParentSide
 from core.enums import CodeType
 
 
+ANCESTRY_SEPARATOR = "/"
+ANCESTRY_UNKNOWN_SIDE = "-"
+ANCESTRY_SIDE_CODES = {ParentSide.LEFT: "L", ParentSide.RIGHT: "R"}
+ANCESTRY_SIDES = {code: side for side, code in ANCESTRY_SIDE_CODES.items()}
+
+
 def account_avatar_directory(instance, filename):
     return "accounts/{0}/avatar/{1}".format(instance.account.account_id, filename)
 
@@ -74,10 +80,82 @@ class Account(models.Model):
     is_deleted = models.BooleanField(
         default=False,
     )
+    # Materialized placement path, root first: "<ancestor pk><side code>/" per level
+    ancestry = models.TextField(default="", blank=True)
+    placement_level = models.PositiveIntegerField(default=0)
+    # Materialized sponsor (referrer) path, top sponsor first: "<sponsor pk>/" per level
+    sponsor_ancestry = models.TextField(default="", blank=True)
+    all_left_children_count = models.PositiveIntegerField(default=0)
+    all_right_children_count = models.PositiveIntegerField(default=0)
 
     class Meta:
         ordering = ["-created", "-id"]
 
+    def save(self, *args, **kwargs):
+        is_new = self._state.adding
+        if self.parent_id and not self.ancestry:
+            self.ancestry, self.placement_level = self.build_ancestry()
+        if self.referrer_id and not self.sponsor_ancestry:
+            self.sponsor_ancestry = self.build_sponsor_ancestry()
+        is_referral_changed = is_new or self.is_referral_changed()
+        saved_referral_key = self.get_saved_referral_key() if is_referral_changed and not is_new else None
+        super().save(*args, **kwargs)
+
+        if is_new:
+            self.increment_upline_children_count()
+        if is_referral_changed:
+            self.update_referral_counts(saved_referral_key)
+            self.loaded_referral_fields = self.get_referral_fields()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Referral counts only move when the sponsor, package or code changed since the account was loaded
+        referral_fields = ["referrer_id", "package_id", "activation_code_id"]
+        if all(field in field_names for field in referral_fields):
+            instance.loaded_referral_fields = instance.get_referral_fields()
+        return instance
+
+    def increment_upline_children_count(self):
+        hops = self.get_ancestry_hops()
+        left_ancestors = [pk for pk, side in hops if side == ParentSide.LEFT]
+        right_ancestors = [pk for pk, side in hops if side == ParentSide.RIGHT]
+
+        if left_ancestors:
+            Account.objects.filter(pk__in=left_ancestors).update(
+                all_left_children_count=models.F("all_left_children_count") + 1
+            )
+        if right_ancestors:
+            Account.objects.filter(pk__in=right_ancestors).update(
+                all_right_children_count=models.F("all_right_children_count") + 1
+            )
+
+    def get_referral_fields(self):
+        return self.referrer_id, self.package_id, self.activation_code_id
+
+    def is_referral_changed(self):
+        loaded_referral_fields = getattr(self, "loaded_referral_fields", None)
+        return loaded_referral_fields is None or loaded_referral_fields != self.get_referral_fields()
+
+    def get_referral_key(self):
+        is_free_slot = self.activation_code is not None and self.activation_code.code_type == CodeType.FREE_SLOT
+        return self.referrer_id, self.package_id, is_free_slot
+
+    def get_saved_referral_key(self):
+        saved = Account.objects.filter(pk=self.pk).values_list("referrer", "package", "activation_code__code_type")
+        for referrer_id, package_id, code_type in saved:
+            return referrer_id, package_id, code_type == CodeType.FREE_SLOT
+
+    def update_referral_counts(self, saved_referral_key=None):
+        referral_key = self.get_referral_key()
+        if referral_key == saved_referral_key:
+            return
+
+        if saved_referral_key and saved_referral_key[0]:
+            update_referral_count(*saved_referral_key, amount=-1)
+        if referral_key[0]:
+            update_referral_count(*referral_key, amount=1)
+
     def get_full_name(self):
         return "%s %s %s" % (self.first_name, self.middle_name, self.last_name)
 
@@ -110,81 +188,103 @@ class Account(models.Model):
             account.get_all_children(children)
         return children
 
-    def get_all_parents(self, parents=None):
-        if parents is None:
-            parents = []
-        if self.parent:
-            parents.append(self.parent)
-            self.parent.get_all_parents(parents)
-        return parents
+    def build_ancestry(self):
+        if self.parent is None:
+            return "", 0
+
+        side_code = ANCESTRY_SIDE_CODES.get(self.parent_side, ANCESTRY_UNKNOWN_SIDE)
+        ancestry = "%s%s%s%s" % (self.parent.ancestry, self.parent.pk, side_code, ANCESTRY_SEPARATOR)
+        return ancestry, self.parent.placement_level + 1
+
+    def get_ancestry_hops(self):
+        """Returns (ancestor pk, side) pairs from the direct parent up to the root."""
+        hops = []
+        for hop in reversed(self.ancestry.split(ANCESTRY_SEPARATOR)):
+            if hop:
+                hops.append((int(hop[:-1]), ANCESTRY_SIDES.get(hop[-1])))
+        return hops
+
+    def is_downline_of(self, account):
+        prefix = "%s%s" % (account.ancestry, account.pk)
+        return any(
+            self.ancestry.startswith("%s%s%s" % (prefix, side_code, ANCESTRY_SEPARATOR))
+            for side_code in list(ANCESTRY_SIDES) + [ANCESTRY_UNKNOWN_SIDE]
+        )
 
-    def get_all_parents_with_side(self, parents=None, level=None):
-        if parents is None:
-            parents = []
-            level = 0
-        if self.parent:
-            level = level + 1
-            parents.append(
-                {"account": self.parent, "side": self.parent_side, "level": level, "package": self.parent.package}
-            )
-            self.parent.get_all_parents_with_side(parents, level)
+    def get_upline(self, hops=None):
+        if hops is None:
+            hops = self.get_ancestry_hops()
+        if not hops:
+            return []
+
+        ancestors = Account.objects.select_related("package").in_bulk([pk for pk, side in hops])
+        parents = []
+        for level, (pk, side) in enumerate(hops, start=1):
+            if pk in ancestors:
+                parents.append(
+                    {"account": ancestors[pk], "side": side, "level": level, "package": ancestors[pk].package}
+                )
         return parents
 
-    def get_all_parents_side(self, sides=None, level=None, parent_id=None):
-        if sides is None:
-            sides = []
-        if self.parent and self.account_id != parent_id:
-            sides.append(self.parent_side)
-            self.parent.get_all_parents_side(sides, level, parent_id)
-        return sides
+    def get_all_parents(self):
+        return [parent["account"] for parent in self.get_upline()]
+
+    def get_all_parents_with_side(self):
+        return self.get_upline()
+
+    def get_all_parents_side(self, parent_id=None):
+        sides = []
+        if self.account_id == parent_id:
+            return sides
 
-    def get_all_parents_side_up_to_main(self, sides=None, level=None):
-        if sides is None:
-            sides = []
-        if self.parent:
-            sides.append(self.parent_side)
-            self.parent.get_all_parents_side_up_to_main(sides, level)
+        hops = self.get_ancestry_hops()
+        account_ids = dict(Account.objects.filter(pk__in=[pk for pk, side in hops]).values_list("pk", "account_id"))
+        for pk, side in hops:
+            sides.append(side)
+            if account_ids.get(pk) == parent_id:
+                break
         return sides
 
-    def get_all_parents_with_extreme_side(self, parents=None, level=None, parent_side=None):
-        if parents is None:
-            parents = []
-            level = 0
-        if self.parent and self.parent_side == parent_side:
-            level = level + 1
-            parents.append(
-                {"account": self.parent, "side": self.parent_side, "level": level, "package": self.parent.package}
-            )
-            self.parent.get_all_parents_with_extreme_side(parents, level, parent_side)
-        return parents
+    def get_all_parents_side_up_to_main(self):
+        return [side for pk, side in self.get_ancestry_hops()]
 
-    def get_two_level_referrer(self, referrers=None, level=None):
-        if referrers is None:
-            referrers = []
-            level = 0
-        if self.referrer:
-            level = level + 1
-            if level > 2:
-                return referrers
-
-            referrers.append(
-                {
-                    "account": self.referrer,
-                    "level": level,
-                    "package": self.referrer.package,
-                }
-            )
+    def get_all_parents_with_extreme_side(self, parent_side=None):
+        hops = []
+        for pk, side in self.get_ancestry_hops():
+            if side != parent_side:
+                break
+            hops.append((pk, side))
+        return self.get_upline(hops)
+
+    def build_sponsor_ancestry(self):
+        if self.referrer is None:
+            return ""
+
+        return "%s%s%s" % (self.referrer.sponsor_ancestry, self.referrer.pk, ANCESTRY_SEPARATOR)
+
+    def get_sponsor_hops(self, levels=None):
+        """Returns sponsor pks from the direct referrer up, at most levels of them."""
+        hops = [int(hop) for hop in reversed(self.sponsor_ancestry.split(ANCESTRY_SEPARATOR)) if hop]
+        return hops[:levels]
+
+    def get_sponsor_upline(self, levels=None):
+        hops = self.get_sponsor_hops(levels)
+        if not hops:
+            return []
 
-            self.referrer.get_two_level_referrer(referrers, level)
-        return referrers
+        sponsors = Account.objects.select_related("package").in_bulk(hops)
+        return [
+            {"account": sponsors[pk], "level": level, "package": sponsors[pk].package}
+            for level, pk in enumerate(hops, start=1)
+            if pk in sponsors
+        ]
 
     def get_all_direct_referral_count(self):
         return self.referrals.all().count()
 
     def get_all_direct_referral_by_package_count(self, package=None):
-        return (
-            self.referrals.all().exclude(activation_code__code_type=CodeType.FREE_SLOT).filter(package=package).count()
-        )
+        referral_count = self.referral_counts.filter(package=package).first()
+        return referral_count.count if referral_count else 0
 
     def get_all_direct_referral_month(self):
         local_tz = get_localzone()
@@ -246,6 +346,48 @@ class Account(models.Model):
         return "%s" % (self.get_full_name())
 
 
+class ReferralCount(models.Model):
+    sponsor = models.ForeignKey(Account, on_delete=models.CASCADE, related_name="referral_counts")
+    package = models.ForeignKey(
+        "core.Package",
+        related_name="referral_counts",
+        on_delete=models.CASCADE,
+        blank=True,
+        null=True,
+    )
+    # Referrals activated with a FREE_SLOT code never count towards referral bonuses
+    count = models.PositiveIntegerField(default=0)
+    free_slot_count = models.PositiveIntegerField(default=0)
+    modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("sponsor", "package")
+        # NULLs never conflict in unique_together, referrals without a package get their own constraint
+        constraints = [
+            models.UniqueConstraint(
+                fields=["sponsor"],
+                condition=models.Q(package__isnull=True),
+                name="unique_referral_count_without_package",
+            )
+        ]
+
+    def __str__(self):
+        return "%s : %s - %s" % (self.package, self.count, self.sponsor)
+
+
+def update_referral_count(sponsor_id=None, package_id=None, is_free_slot=False, amount=0):
+    field = "free_slot_count" if is_free_slot else "count"
+    referral_counts = ReferralCount.objects.filter(sponsor_id=sponsor_id, package_id=package_id)
+    # Counts never go below zero, a removed referral that was never counted leaves them as they are
+    increment = {field: Greatest(models.F(field) + amount, 0)}
+    if not referral_counts.update(**increment):
+        # Concurrent first referrals of a package both insert, the loser is ignored and both then increment
+        ReferralCount.objects.bulk_create(
+            [ReferralCount(sponsor_id=sponsor_id, package_id=package_id)], ignore_conflicts=True
+        )
+        referral_counts.update(**increment)
+
+
 class PersonalInfo(models.Model):
     account = models.OneToOneField(Account, on_delete=models.CASCADE, related_name="personal_info")
     birthdate = models.DateField(
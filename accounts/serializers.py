@@ -1,5 +1,6 @@
 from rest_framework.serializers import ModelSerializer
 from rest_framework import serializers
+from django.conf import settings
 from django.utils import timezone
 from .models import *
 from users.serializers import UserSerializer
@@ -225,7 +226,7 @@ class AccountListSerializer(ModelSerializer):
 class AccountReferralsSerializer(ModelSerializer):
     account_name = serializers.CharField(source="get_account_name", required=False)
     account_number = serializers.CharField(source="get_account_number", required=False)
-    referrals = serializers.IntegerField(source="get_all_direct_referral_count", required=False)
+    referrals = serializers.IntegerField(source="referral_count", read_only=True)
 
     class Meta:
         model = Account
@@ -338,7 +339,7 @@ class GenealogyAccountMemberSerializer(ModelSerializer):
 
     def get_fields(self):
         fields = super().get_fields()
-        if self.depth < 5:
+        if self.depth < settings.GENEALOGY_DEPTH:
             fields["children"] = RecursiveField(many=True, required=False)
         else:
             del fields["children"]
@@ -397,7 +398,7 @@ class GenealogyAccountAdminSerializer(ModelSerializer):
 
     def get_fields(self):
         fields = super().get_fields()
-        if self.depth < 5:
+        if self.depth < settings.GENEALOGY_DEPTH:
             fields["children"] = RecursiveField(many=True, required=False)
         else:
             del fields["children"]
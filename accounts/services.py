@@ -1,11 +1,17 @@
 import json
 import random
+import re
 import uuid
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection
 from django.http import QueryDict
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from accounts.models import Account, AvatarInfo, CashoutMethod
 from accounts.enums import AccountStatus
 from core.enums import CodeStatus
+from core.models import LeaderboardEntry, Package, get_leaderboard_period
 from core.services import get_code_details
 from users.services import create_new_user
 
@@ -211,3 +217,171 @@ def process_media(account, attachment):
         avatar_info.save()
 
     return avatar_info
+
+
+def get_leaderboard_size(request):
+    limit = request.query_params.get("limit", None)
+    if limit is not None and limit.isdigit():
+        return min(int(limit), settings.LEADERBOARD_MAX_SIZE)
+
+    return settings.LEADERBOARD_SIZE
+
+
+def get_leaderboard_period_param(request):
+    period = request.query_params.get("period", None)
+    if period == "current":
+        return get_leaderboard_period(timezone.localdate())
+    if period is None:
+        return LeaderboardEntry.ALL_TIME
+    if re.fullmatch(r"\d{4}-\d{2}", period):
+        return period
+
+    return None
+
+
+def get_genealogy_depth(request):
+    depth = request.query_params.get("depth", None)
+    if depth is not None and depth.isdigit():
+        return min(int(depth), settings.GENEALOGY_MAX_DEPTH)
+
+    return settings.GENEALOGY_DEPTH
+
+
+def fetch_genealogy_rows(account, depth=None):
+    """
+    Fetches the placement subtree of account down to depth levels in a single recursive query,
+    ordered by depth then parent side, joined with each node's package name and avatar.
+    """
+    if depth is None:
+        depth = settings.GENEALOGY_DEPTH
+
+    query = """
+        WITH RECURSIVE genealogy AS (
+            SELECT id, account_id, parent_id, parent_side, package_id, first_name, middle_name, last_name,
+                account_status, all_left_children_count, all_right_children_count, 0 AS depth
+            FROM {account_table}
+            WHERE id = %s
+            UNION ALL
+            SELECT child.id, child.account_id, child.parent_id, child.parent_side, child.package_id,
+                child.first_name, child.middle_name, child.last_name, child.account_status,
+                child.all_left_children_count, child.all_right_children_count, genealogy.depth + 1
+            FROM {account_table} child
+            INNER JOIN genealogy ON child.parent_id = genealogy.id
+            WHERE genealogy.depth < %s
+        )
+        SELECT genealogy.*, package.package_name, avatar.file_attachment
+        FROM genealogy
+        LEFT JOIN {package_table} package ON package.id = genealogy.package_id
+        LEFT JOIN {avatar_table} avatar ON avatar.account_id = genealogy.id
+        ORDER BY genealogy.depth, genealogy.parent_side
+    """.format(
+        account_table=Account._meta.db_table,
+        package_table=Package._meta.db_table,
+        avatar_table=AvatarInfo._meta.db_table,
+    )
+
+    # chunked_cursor is server-side where the backend supports it, so large subtrees are read in batches
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(query, [account.pk, depth])
+        columns = [column[0] for column in cursor.description]
+        while True:
+            rows = cursor.fetchmany(settings.GENEALOGY_CHUNK_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(zip(columns, row))
+
+
+def get_genealogy_avatar_url(file_attachment, request=None):
+    if not file_attachment:
+        return None
+
+    url = AvatarInfo._meta.get_field("file_attachment").storage.url(file_attachment)
+    if request is not None:
+        return request.build_absolute_uri(url)
+    return url
+
+
+def build_genealogy_node(row, path, request=None):
+    return {
+        "account_id": str(uuid.UUID(str(row["account_id"]))),
+        "account_name": "%s %s" % (row["first_name"], row["last_name"]),
+        "account_full_name": "%s %s %s" % (row["first_name"], row["middle_name"], row["last_name"]),
+        "account_number": str(row["id"]).zfill(5),
+        "account_status": row["account_status"],
+        "package_name": row["package_name"],
+        "parent_side": row["parent_side"],
+        "depth": row["depth"],
+        "avatar": get_genealogy_avatar_url(row["file_attachment"], request),
+        "all_left_children_count": str(row["all_left_children_count"]),
+        "all_right_children_count": str(row["all_right_children_count"]),
+        "path": path,
+    }
+
+
+def get_genealogy_tree(account, depth=None, parent_id=None, request=None):
+    """
+    Returns the nested genealogy of account in the shape of the genealogy serializers. Paths are
+    sides from each node up to the account identified by parent_id.
+    """
+    if depth is None:
+        depth = settings.GENEALOGY_DEPTH
+
+    nodes = {}
+    tree = None
+    for row in fetch_genealogy_rows(account, depth):
+        parent = nodes.get(row["parent_id"])
+        if tree is None:
+            path = account.get_all_parents_side(parent_id=parent_id)
+        else:
+            path = [row["parent_side"]] + parent["path"]
+
+        node = build_genealogy_node(row, path, request)
+        if row["depth"] < depth:
+            node["children"] = []
+        nodes[row["id"]] = node
+
+        if tree is None:
+            tree = node
+        else:
+            parent["children"].append(node)
+
+    return tree
+
+
+def iter_genealogy_nodes(account, depth=None, parent_id=None, request=None):
+    """
+    Yields the genealogy of account as flat nodes, level by level, each carrying its parent's
+    account_id. Only the previous level is kept in memory to derive paths.
+    """
+    previous_level = {}
+    current_level = {}
+    current_depth = 0
+    for row in fetch_genealogy_rows(account, depth):
+        if row["depth"] != current_depth:
+            previous_level, current_level = current_level, {}
+            current_depth = row["depth"]
+
+        parent = previous_level.get(row["parent_id"])
+        if parent is None:
+            path = account.get_all_parents_side(parent_id=parent_id)
+            parent_account_id = None
+        else:
+            path = [row["parent_side"]] + parent["path"]
+            parent_account_id = parent["account_id"]
+
+        node = build_genealogy_node(row, path, request)
+        node["parent_account_id"] = parent_account_id
+        current_level[row["id"]] = node
+
+        yield node
+
+
+def stream_genealogy(accounts, depth=None, parent_id=None, request=None):
+    yield "["
+    is_first = True
+    for account in accounts:
+        for node in iter_genealogy_nodes(account, depth, parent_id, request):
+            yield ("" if is_first else ",") + json.dumps(node, cls=DjangoJSONEncoder)
+            is_first = False
+    yield "]"
@@ -1,5 +1,21 @@
 from django.contrib import admin
-from core.models import Setting, Package, ReferralBonus, LeadershipBonus, Code, Activity, ActivityDetails, Franchisee
+from core.models import (
+    Setting,
+    Package,
+    ReferralBonus,
+    LeadershipBonus,
+    Code,
+    Activity,
+    ActivityDetails,
+    Franchisee,
+    PointValueBalance,
+    DailySalesMatch,
+    FifthPairProgress,
+    WalletBalance,
+    LeaderboardEntry,
+    ActivityDailyRollup,
+    AccountActivityDailyRollup,
+)
 
 
 class ActivityAdmin(admin.ModelAdmin):
@@ -21,3 +37,10 @@ admin.site.register(Code)
 admin.site.register(Activity, ActivityAdmin)
 admin.site.register(ActivityDetails)
 admin.site.register(Franchisee)
+admin.site.register(PointValueBalance)
+admin.site.register(DailySalesMatch)
+admin.site.register(FifthPairProgress)
+admin.site.register(WalletBalance)
+admin.site.register(LeaderboardEntry)
+admin.site.register(ActivityDailyRollup)
+admin.site.register(AccountActivityDailyRollup)
@@ -1,11 +1,19 @@
+import datetime
+import decimal
+from collections import defaultdict
+from tzlocal import get_localzone
 from rest_framework import status, views, permissions
 from rest_framework.viewsets import ModelViewSet
 from rest_framework.response import Response
+from django.conf import settings
 from django.shortcuts import get_object_or_404
 from django.template.loader import render_to_string
+from django.db import transaction
+from django.utils import timezone
 from django.db.models import Sum, F, Q, Case, When, DecimalField
 from django.db.models.functions import Coalesce
 from accounts.models import Account
+from accounts.services import is_valid_uuid
 from core.services import (
     check_if_has_cashout_today,
     check_if_has_pending_cashout,
@@ -13,23 +21,30 @@ from core.services import (
     compute_cashout_total,
     create_company_earning_activity,
     find_total_sales_match_points_today,
+    get_activity_time_series,
+    get_activity_totals,
     get_all_enums,
     get_cashout_total_tax,
     compute_minimum_cashout_amount,
     get_setting,
     get_wallet_can_cashout,
     get_wallet_cashout_schedule,
+    get_wallet_summaries,
     process_create_cashout_request,
     create_payout_activity,
     process_create_franchisee_request,
     process_save_cashout_status,
     send_email,
+    summarize_wallets,
     update_code_status,
     verify_code_details,
 )
+from core.simulations import SIMULATED_SETTINGS, compare_payouts
 from vanguard.permissions import IsDeveloperUser, IsAdminUser, IsStaffUser, IsMemberUser
 from vanguard.throttle import FivePerMinuteAnonThrottle
+from users.enums import UserType
 from core.enums import ActivityStatus, ActivityType, CashoutMethod, CodeStatus, CodeType, WalletType, Settings
+from core.enums import TimeSeriesBucket, TimeSeriesMetric
 from core.models import (
     Franchisee,
     Setting,
@@ -38,8 +53,13 @@ from core.models import (
     LeadershipBonus,
     Code,
     Activity,
+    PointValueBalance,
+    POINT_VALUE_WALLETS,
+    WalletBalance,
+    CompPlanJob,
 )
 from core.serializers import (
+    CompPlanJobSerializer,
     ActivityCashoutInfoSerializer,
     ActivityCashoutListSerializer,
     CreateActivitiesSerializer,
@@ -469,21 +489,20 @@ class SummaryAdminView(views.APIView):
 
     def post(self, request, *args, **kwargs):
         data = []
-        entry_count = Activity.objects.filter(activity_type=ActivityType.ENTRY).count()
-        data.append({"activity": ActivityType.ENTRY, "summary": entry_count})
+        counts = defaultdict(int)
+        for total in get_activity_totals(["activity_type", "wallet"]):
+            counts[total["activity_type"]] += total["count"]
+            counts[(total["activity_type"], total["wallet"])] += total["count"]
 
-        franchise_referrals = Activity.objects.filter(activity_type=ActivityType.FRANCHISE_COMMISSION).count()
-        data.append({"activity": ActivityType.FRANCHISE_COMMISSION, "summary": franchise_referrals})
-
-        referrals_count = Activity.objects.filter(activity_type=ActivityType.DIRECT_REFERRAL).count()
-        data.append({"activity": ActivityType.DIRECT_REFERRAL, "summary": referrals_count})
-
-        sales_match_count = Activity.objects.filter(activity_type=ActivityType.SALES_MATCH).count()
-        data.append({"activity": ActivityType.SALES_MATCH, "summary": sales_match_count})
+        for activity_type in [
+            ActivityType.ENTRY,
+            ActivityType.FRANCHISE_COMMISSION,
+            ActivityType.DIRECT_REFERRAL,
+            ActivityType.SALES_MATCH,
+        ]:
+            data.append({"activity": activity_type, "summary": counts[activity_type]})
 
-        flush_out_count = Activity.objects.filter(
-            activity_type=ActivityType.FLUSH_OUT_PENALTY, wallet=WalletType.PV_LEFT_WALLET
-        ).count()
+        flush_out_count = counts[(ActivityType.FLUSH_OUT_PENALTY, WalletType.PV_LEFT_WALLET)]
         data.append({"activity": ActivityType.FLUSH_OUT_PENALTY, "summary": flush_out_count})
 
         return Response(
@@ -538,24 +557,17 @@ class SummaryActivityAmountAdminView(views.APIView):
     def post(self, request, *args, **kwargs):
         data = []
         ActivityFilter = [ActivityType.DOWNLINE_ENTRY, ActivityType.GLOBAL_POOL_BONUS, ActivityType.PV_SALES_MATCH]
+        activity_totals = defaultdict(decimal.Decimal)
+        for total in get_activity_totals(["activity_type", "wallet"]):
+            if total["wallet"] not in [WalletType.PV_LEFT_WALLET, WalletType.PV_RIGHT_WALLET]:
+                activity_totals[total["activity_type"]] += total["amount"]
+
         for activity in ActivityType:
             if activity not in ActivityFilter:
-                activities = (
-                    Activity.objects.filter(activity_type=activity)
-                    .exclude(Q(wallet=WalletType.PV_LEFT_WALLET) | Q(wallet=WalletType.PV_RIGHT_WALLET))
-                    .values("activity_type")
-                    .annotate(activity_total=Sum(F("activity_amount")))
-                    .order_by("-activity_total")
-                )
-
-                wallet_total = activities.aggregate(
-                    total=Coalesce(Sum("activity_total"), 0, output_field=DecimalField())
-                ).get("total")
-
                 data.append(
                     {
                         "activity": activity,
-                        "total": wallet_total,
+                        "total": activity_totals[activity],
                     }
                 )
 
@@ -610,60 +622,66 @@ class SummaryWalletAdminView(views.APIView):
     permission_classes = [IsDeveloperUser | IsAdminUser | IsStaffUser]
 
     def post(self, request, *args, **kwargs):
-        data = []
-        activities = (
-            Activity.objects.filter(wallet=WalletType.C_WALLET)
-            .values("activity_type")
-            .annotate(
-                running_total=Case(
-                    When(
-                        ~Q(activity_type=ActivityType.PAYOUT),
-                        then=Sum(F("activity_amount")),
-                    ),
-                ),
-                activity_total=Case(
-                    When(
-                        Q(activity_type=ActivityType.PAYOUT),
-                        then=0 - (Sum(F("activity_amount"))),
-                    ),
-                    When(
-                        ~Q(activity_type=ActivityType.PAYOUT),
-                        then=(Sum(F("activity_amount"))),
-                    ),
-                ),
-                payout_total=Case(
-                    When(
-                        Q(activity_type=ActivityType.PAYOUT),
-                        then=0 - (Sum(F("activity_amount"))),
-                    ),
-                ),
-            )
-            .order_by("-activity_total")
+        summaries = summarize_wallets(
+            get_activity_totals(["wallet", "activity_type"], wallet=WalletType.C_WALLET),
+            [WalletType.C_WALLET],
+            deduction_type=ActivityType.PAYOUT,
+            deduction_name="payout",
         )
-        wallet_running_total = activities.aggregate(
-            total=Coalesce(Sum("running_total"), 0, output_field=DecimalField())
-        ).get("total")
+        data = [
+            {"wallet": wallet, "wallet_display": wallet + "_SUMMARY", **summary}
+            for wallet, summary in summaries.items()
+        ]
 
-        wallet_total = activities.aggregate(total=Coalesce(Sum("activity_total"), 0, output_field=DecimalField())).get(
-            "total"
+        return Response(
+            data=data,
+            status=status.HTTP_200_OK,
         )
-        wallet_total_payout = activities.aggregate(
-            total=Coalesce(Sum("payout_total"), 0, output_field=DecimalField())
-        ).get("total")
 
-        data.append(
-            {
-                "wallet": WalletType.C_WALLET,
-                "wallet_display": WalletType.C_WALLET + "_SUMMARY",
-                "running_total": wallet_running_total,
-                "total": wallet_total,
-                "payout": wallet_total_payout,
-                "details": activities,
-            }
-        )
+
+class ActivityTimeSeriesView(views.APIView):
+    permission_classes = [IsDeveloperUser | IsAdminUser | IsStaffUser | IsMemberUser]
+
+    def post(self, request, *args, **kwargs):
+        try:
+            metric = TimeSeriesMetric(request.data.get("metric"))
+            bucket = TimeSeriesBucket(request.data.get("bucket", TimeSeriesBucket.DAY))
+            end = request.data.get("end")
+            end = datetime.date.fromisoformat(end) if end else timezone.localdate(timezone=get_localzone())
+            start = request.data.get("start")
+            start = (
+                datetime.date.fromisoformat(start)
+                if start
+                else end - datetime.timedelta(days=settings.TIME_SERIES_DEFAULT_DAYS - 1)
+            )
+        except (TypeError, ValueError):
+            return Response(
+                data={"message": "Invalid time series."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if start > end or (end - start).days >= settings.TIME_SERIES_MAX_DAYS:
+            return Response(
+                data={"message": "Time series can cover up to %s days." % settings.TIME_SERIES_MAX_DAYS},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        account = None
+        account_id = request.data.get("account_id")
+        if account_id:
+            if not is_valid_uuid(account_id):
+                return Response(
+                    data={"message": "Invalid account."},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            account = get_object_or_404(Account, account_id=account_id)
+        if request.user.user_type == UserType.MEMBER and (account is None or account.user_id != request.user.pk):
+            return Response(
+                data={"message": "Members can only view the time series of their own accounts."},
+                status=status.HTTP_403_FORBIDDEN,
+            )
 
         return Response(
-            data=data,
+            data=get_activity_time_series(metric, bucket, start, end, account),
             status=status.HTTP_200_OK,
         )
 
@@ -673,65 +691,20 @@ class SummaryWalletMemberView(views.APIView):
 
     def post(self, request, *args, **kwargs):
         account_id = request.data.get("account_id")
-        data = []
         WalletFilter = [
             WalletType.C_WALLET,
             WalletType.PV_LEFT_WALLET,
             WalletType.PV_RIGHT_WALLET,
             WalletType.PV_TOTAL_WALLET,
         ]
-        for wallet in WalletType:
-            if wallet not in WalletFilter:
-                activities = (
-                    Activity.objects.filter(account__account_id=account_id, wallet=wallet)
-                    .values("activity_type")
-                    .annotate(
-                        running_total=Case(
-                            When(
-                                ~Q(activity_type=ActivityType.CASHOUT),
-                                then=Sum(F("activity_amount")),
-                            ),
-                        ),
-                        activity_total=Case(
-                            When(
-                                Q(activity_type=ActivityType.CASHOUT) & ~Q(status=ActivityStatus.DENIED),
-                                then=0 - (Sum(F("activity_amount"))),
-                            ),
-                            When(
-                                ~Q(activity_type=ActivityType.CASHOUT),
-                                then=Sum(F("activity_amount")),
-                            ),
-                        ),
-                        cashout_total=Case(
-                            When(
-                                Q(activity_type=ActivityType.CASHOUT),
-                                then=0 - (Sum(F("activity_amount"))),
-                            ),
-                        ),
-                    )
-                    .order_by("-activity_total")
-                )
-
-                wallet_running_total = activities.aggregate(
-                    total=Coalesce(Sum("running_total"), 0, output_field=DecimalField())
-                ).get("total")
-                wallet_total = activities.aggregate(
-                    total=Coalesce(Sum("activity_total"), 0, output_field=DecimalField())
-                ).get("total")
-                wallet_total_cashout = activities.aggregate(
-                    total=Coalesce(Sum("cashout_total"), 0, output_field=DecimalField())
-                ).get("total")
-
-                data.append(
-                    {
-                        "wallet": wallet,
-                        "wallet_display": wallet + "_SUMMARY",
-                        "running_total": wallet_running_total,
-                        "total": wallet_total,
-                        "cashout": wallet_total_cashout,
-                        "details": activities,
-                    }
-                )
+        summaries = get_wallet_summaries(
+            Activity.objects.filter(account__account_id=account_id),
+            [wallet for wallet in WalletType if wallet not in WalletFilter],
+        )
+        data = [
+            {"wallet": wallet, "wallet_display": wallet + "_SUMMARY", **summary}
+            for wallet, summary in summaries.items()
+        ]
 
         return Response(
             data=data,
@@ -749,23 +722,27 @@ class SummaryPVWalletAdminView(views.APIView):
             WalletType.B_WALLET,
             WalletType.F_WALLET,
         ]
+        pv_wallet_totals = dict(
+            PointValueBalance.objects.values("wallet").annotate(total=Sum("balance")).values_list("wallet", "total")
+        )
+        summaries = get_wallet_summaries(
+            Activity.objects.all(),
+            [wallet for wallet in WalletType if wallet not in WalletFilter and wallet not in POINT_VALUE_WALLETS],
+        )
         for wallet in WalletType:
-            if wallet not in WalletFilter:
-                activities = (
-                    Activity.objects.filter(wallet=wallet)
-                    .values("activity_type")
-                    .annotate(activity_total=Sum(F("activity_amount")))
-                    .order_by("-activity_total")
-                )
-                wallet_total = activities.aggregate(
-                    total=Coalesce(Sum("activity_total"), 0, output_field=DecimalField())
-                ).get("total")
-                data.append(
-                    {
-                        "wallet": wallet,
-                        "total": wallet_total,
-                    }
-                )
+            if wallet in POINT_VALUE_WALLETS:
+                wallet_total = pv_wallet_totals.get(wallet, 0)
+            elif wallet not in WalletFilter:
+                # Every activity of the wallet counts here, cashouts included
+                wallet_total = summaries[wallet]["running_total"] - summaries[wallet]["cashout"]
+            else:
+                continue
+            data.append(
+                {
+                    "wallet": wallet,
+                    "total": wallet_total,
+                }
+            )
 
         return Response(
             data=data,
@@ -779,37 +756,15 @@ class SummaryPVWalletMemberView(views.APIView):
     def post(self, request, *args, **kwargs):
         account_id = request.data.get("account_id")
         data = []
+        pv_wallet_balances = {
+            pv_wallet_balance.wallet: pv_wallet_balance
+            for pv_wallet_balance in PointValueBalance.objects.filter(account__account_id=account_id)
+        }
         for wallet in [WalletType.PV_LEFT_WALLET, WalletType.PV_TOTAL_WALLET, WalletType.PV_RIGHT_WALLET]:
-            activities = (
-                Activity.objects.filter(account__account_id=account_id, wallet=wallet)
-                .values("activity_type")
-                .annotate(
-                    running_total=Case(
-                        When(
-                            Q(activity_type=ActivityType.DOWNLINE_ENTRY),
-                            then=Sum(F("activity_amount")),
-                        ),
-                    ),
-                    flushout_total=Case(
-                        When(
-                            Q(activity_type=ActivityType.FLUSH_OUT_PENALTY),
-                            then=Sum(F("activity_amount")),
-                        ),
-                    ),
-                    activity_total=Sum(F("activity_amount")),
-                )
-                .order_by("-activity_total")
-            )
-            wallet_total = activities.aggregate(
-                total=Coalesce(Sum("activity_total"), 0, output_field=DecimalField())
-            ).get("total")
-            wallet_running_total = activities.aggregate(
-                total=Coalesce(Sum("running_total"), 0, output_field=DecimalField())
-            ).get("total")
-
-            wallet_flushout_total = activities.aggregate(
-                total=Coalesce(Sum("flushout_total"), 0, output_field=DecimalField())
-            ).get("total")
+            pv_wallet_balance = pv_wallet_balances.get(wallet, PointValueBalance())
+            wallet_total = pv_wallet_balance.balance
+            wallet_running_total = pv_wallet_balance.running_total
+            wallet_flushout_total = pv_wallet_balance.flushout_total
 
             data.append(
                 {
@@ -923,38 +878,19 @@ class WalletMaxAmountView(views.APIView):
         account_id = request.data.get("account_id")
         amount = request.data.get("amount")
         if wallet is not None and account_id is not None and amount is not None:
-            activities = (
-                Activity.objects.filter(account__account_id=account_id, wallet=wallet)
-                .values("activity_type")
-                .annotate(
-                    running_total=Case(
-                        When(
-                            ~Q(activity_type=ActivityType.CASHOUT),
-                            then=Sum(F("activity_amount")),
-                        ),
-                    ),
-                    activity_total=Case(
-                        When(
-                            Q(activity_type=ActivityType.CASHOUT),
-                            then=0 - (Sum(F("activity_amount"))),
-                        ),
-                        When(
-                            ~Q(activity_type=ActivityType.CASHOUT),
-                            then=Sum(F("activity_amount")),
-                        ),
-                    ),
-                    cashout_total=Case(
-                        When(
-                            Q(activity_type=ActivityType.CASHOUT),
-                            then=0 - (Sum(F("activity_amount"))),
-                        ),
-                    ),
-                )
-                .order_by("-activity_total")
-            )
-            wallet_total = activities.aggregate(
-                total=Coalesce(Sum("activity_total"), 0, output_field=DecimalField())
-            ).get("total")
+            available = (
+                WalletBalance.objects.filter(account__account_id=account_id, wallet=wallet)
+                .values_list("available", flat=True)
+                .first()
+            ) or 0
+            # Denied cashouts are given back to the balance but have always counted against the cashout limit
+            denied_cashout = Activity.objects.filter(
+                account__account_id=account_id,
+                wallet=wallet,
+                activity_type=ActivityType.CASHOUT,
+                status=ActivityStatus.DENIED,
+            ).aggregate(total=Coalesce(Sum("activity_amount"), 0, output_field=DecimalField()))["total"]
+            wallet_total = available - denied_cashout
             if wallet_total - int(amount) >= 0:
                 can_cashout, minimum_cashout_amount = compute_minimum_cashout_amount(amount, wallet)
                 if can_cashout:
@@ -1037,6 +973,7 @@ class RequestCashoutView(views.APIView):
 class UpdateCashoutStatusView(views.APIView):
     permission_classes = [IsDeveloperUser | IsAdminUser | IsStaffUser]
 
+    @transaction.atomic
     def post(self, request, *args, **kwargs):
         cashout, processed_request = process_save_cashout_status(request)
         serializer = CreateActivitiesSerializer(cashout, data=processed_request)
@@ -1172,3 +1109,60 @@ class SendEmailView(views.APIView):
             data={"message": message},
             status=status.HTTP_200_OK,
         )
+
+
+class CompPlanJobStatusView(views.APIView):
+    permission_classes = [IsDeveloperUser | IsAdminUser | IsStaffUser | IsMemberUser]
+
+    def post(self, request, *args, **kwargs):
+        job_id = request.data.get("job_id")
+        if not is_valid_uuid(job_id):
+            return Response(
+                data={"message": "Invalid Job."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        jobs = CompPlanJob.objects.select_related("account")
+        if request.user.user_type not in [UserType.DEVELOPER, UserType.ADMIN, UserType.STAFF]:
+            jobs = jobs.filter(Q(created_by=request.user) | Q(account__user=request.user))
+        job = get_object_or_404(jobs, job_id=job_id)
+        serializer = CompPlanJobSerializer(job)
+
+        return Response(
+            data=serializer.data,
+            status=status.HTTP_200_OK,
+        )
+
+
+class SimulatePayoutsView(views.APIView):
+    permission_classes = [IsDeveloperUser | IsAdminUser]
+
+    def post(self, request, *args, **kwargs):
+        simulated_settings = request.data.get("settings") or {}
+        flush_out_limits = request.data.get("flush_out_limits") or {}
+        if any(property not in SIMULATED_SETTINGS for property in simulated_settings):
+            return Response(
+                data={"message": "Setting can not be simulated."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        try:
+            start = request.data.get("start")
+            end = request.data.get("end")
+            result = compare_payouts(
+                simulated_settings,
+                flush_out_limits,
+                datetime.date.fromisoformat(start) if start else None,
+                datetime.date.fromisoformat(end) if end else None,
+                int(request.data.get("limit", 10)),
+            )
+        except (KeyError, TypeError, ValueError):
+            return Response(
+                data={"message": "Invalid simulation."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        return Response(
+            data=result,
+            status=status.HTTP_200_OK,
+        )
@@ -0,0 +1,175 @@
+import statistics
+import time
+from django.db import connection, transaction
+from django.db.models import Q
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+from accounts.api import GenealogyAccountAdminViewSet, GenealogyAccountMemberViewSet, TopAccountWalletViewSet
+from accounts.enums import GenealogyMode, ParentSide
+from accounts.models import Account
+from core.api import SummaryWalletMemberView, WalletMaxAmountView
+from core.enums import CodeStatus, CodeType, WalletType
+from core.models import Code
+from core.services import CompPlanJobRequest, comp_plan
+from users.enums import UserType
+from users.models import User
+
+
+class BenchmarkNetwork:
+    """
+    The generated network the benchmarks run against: its root, an admin user and a member user that owns the root.
+    """
+
+    def __init__(self):
+        self.root = Account.objects.filter(parent__isnull=True).order_by("id").first()
+        self.max_level = Account.objects.order_by("-placement_level").values_list("placement_level", flat=True)[0]
+        self.admin = User.objects.create(
+            username="benchmark-admin", email_address="benchmark-admin@example.com", user_type=UserType.ADMIN
+        )
+        self.member = User.objects.create(
+            username="benchmark-member", email_address="benchmark-member@example.com", user_type=UserType.MEMBER
+        )
+        self.root.user = self.member
+        self.root.save(update_fields=["user"])
+        self.factory = APIRequestFactory()
+
+    def get_depths(self):
+        # Upline lengths of the registrations the comp plan is timed on, the longest one below the deepest leaf
+        return sorted({1, max((self.max_level + 1) // 2, 1), self.max_level + 1})
+
+
+def call_view(network=None, view=None, user=None, method="get", data=None):
+    request = getattr(network.factory, method)("/", data, format="json" if method == "post" else None)
+    force_authenticate(request, user=user)
+    response = view(request)
+    if response.streaming:
+        return b"".join(response.streaming_content)
+
+    return response.render().content
+
+
+def prepare_comp_plan(network=None, depth=None):
+    # Registers a new member on the shallowest free slot at least depth - 1 levels down, so the comp plan walks at
+    # least depth parents
+    parent = (
+        Account.objects.filter(
+            Q(all_left_children_count=0) | Q(all_right_children_count=0), placement_level__gte=depth - 1
+        )
+        .select_related("package")
+        .order_by("placement_level", "id")
+        .first()
+    )
+    code = Code.objects.create(
+        code="BENCHMARK", package=parent.package, code_type=CodeType.ACTIVATION, status=CodeStatus.USED
+    )
+    new_member = Account.objects.create(
+        parent=parent,
+        parent_side=ParentSide.LEFT if parent.all_left_children_count == 0 else ParentSide.RIGHT,
+        activation_code=code,
+        package=parent.package,
+        referrer=parent,
+        first_name="Benchmark",
+        last_name="Member",
+    )
+    request = CompPlanJobRequest(network.admin)
+
+    return lambda: comp_plan(request, new_member, parent.package, code)
+
+
+def prepare_genealogy_admin(network=None, mode=None):
+    view = GenealogyAccountAdminViewSet.as_view({"get": "list"})
+    data = {"account_id": str(network.root.account_id), "depth": 10}
+    if mode:
+        data["mode"] = mode
+
+    return lambda: call_view(network, view, network.admin, data=data)
+
+
+def prepare_genealogy_member(network=None):
+    view = GenealogyAccountMemberViewSet.as_view({"get": "list"})
+    data = {"account_id": str(network.root.account_id), "depth": 10}
+
+    return lambda: call_view(network, view, network.member, data=data)
+
+
+def prepare_summary_wallet_member(network=None):
+    view = SummaryWalletMemberView.as_view()
+    data = {"account_id": str(network.root.account_id)}
+
+    return lambda: call_view(network, view, network.member, "post", data)
+
+
+def prepare_wallet_max_amount(network=None):
+    view = WalletMaxAmountView.as_view()
+    data = {"wallet": WalletType.B_WALLET, "account_id": str(network.root.account_id), "amount": 1}
+
+    return lambda: call_view(network, view, network.member, "post", data)
+
+
+def prepare_top_earners(network=None):
+    view = TopAccountWalletViewSet.as_view({"get": "list"})
+
+    return lambda: call_view(network, view, network.admin)
+
+
+def get_benchmarks(network=None):
+    benchmarks = [("comp_plan_depth_%s" % depth, prepare_comp_plan, {"depth": depth}) for depth in network.get_depths()]
+    benchmarks += [
+        ("genealogy_admin", prepare_genealogy_admin, {}),
+        ("genealogy_admin_flat", prepare_genealogy_admin, {"mode": GenealogyMode.FLAT}),
+        ("genealogy_member", prepare_genealogy_member, {}),
+        ("summary_wallet_member", prepare_summary_wallet_member, {}),
+        ("wallet_max_amount", prepare_wallet_max_amount, {}),
+        ("top_earners", prepare_top_earners, {}),
+    ]
+    return benchmarks
+
+
+def get_rows_scanned():
+    # Only PostgreSQL reports the rows read by the current transaction
+    if connection.vendor != "postgresql":
+        return None
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT COALESCE(SUM(seq_tup_read + COALESCE(idx_tup_fetch, 0)), 0) FROM pg_stat_xact_user_tables"
+        )
+        return int(cursor.fetchone()[0])
+
+
+def run_benchmark(network=None, prepare=None, options=None, repeat=None):
+    """
+    Runs an operation repeat times, each in a savepoint that is rolled back afterwards so every run starts from the
+    same data, and returns its median wall time with the queries and rows scanned of the last run.
+    """
+    timings = []
+    for _ in range(repeat):
+        with transaction.atomic():
+            operation = prepare(network, **options)
+            rows_scanned = get_rows_scanned()
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                operation()
+                timings.append(time.perf_counter() - started)
+            if rows_scanned is not None:
+                rows_scanned = get_rows_scanned() - rows_scanned
+            transaction.set_rollback(True)
+
+    return {"seconds": statistics.median(timings), "queries": len(queries), "rows_scanned": rows_scanned}
+
+
+def compare_benchmark(result=None, baseline=None, tolerance=None, noise=None):
+    # Timings within noise seconds of the allowed slowdown are not regressions, millisecond operations jitter more
+    # than any tolerance
+    regressions = []
+    if result["seconds"] > baseline["seconds"] * (1 + tolerance) + noise:
+        regressions.append("seconds %.4f > %.4f" % (result["seconds"], baseline["seconds"]))
+    if result["queries"] > baseline["queries"]:
+        regressions.append("queries %s > %s" % (result["queries"], baseline["queries"]))
+    if (
+        result["rows_scanned"] is not None
+        and baseline.get("rows_scanned") is not None
+        and result["rows_scanned"] > baseline["rows_scanned"] * (1 + tolerance)
+    ):
+        regressions.append("rows scanned %s > %s" % (result["rows_scanned"], baseline["rows_scanned"]))
+    return regressions
@@ -95,3 +95,28 @@ class CashoutMethod(models.TextChoices):
     BDO = "BDO", _("BDO")
     CHECQUE = "Checque", _("Checque")
     OTHERS = 'Other/s', _("Other/s")
+
+
+class CompPlanJobType(models.TextChoices):
+    CREATE = "CREATE", _("Create")
+    UPGRADE = "UPGRADE", _("Upgrade")
+
+
+class CompPlanJobStatus(models.TextChoices):
+    PENDING = "PENDING", _("Pending")
+    RUNNING = "RUNNING", _("Running")
+    DONE = "DONE", _("Done")
+    FAILED = "FAILED", _("Failed")
+
+
+class TimeSeriesMetric(models.TextChoices):
+    EARNINGS = "EARNINGS", _("Earnings")
+    ENTRIES = "ENTRIES", _("Entries")
+    CASHOUTS = "CASHOUTS", _("Cashouts")
+    FLUSH_OUTS = "FLUSH_OUTS", _("Flush Outs")
+
+
+class TimeSeriesBucket(models.TextChoices):
+    DAY = "day", _("Day")
+    WEEK = "week", _("Week")
+    MONTH = "month", _("Month")
@@ -0,0 +1,33 @@
+import time
+from django.core.management.base import BaseCommand
+from core.enums import CompPlanJobStatus
+from core.services import claim_comp_plan_jobs, run_comp_plan_jobs
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs queued comp plan jobs, oldest first within each genealogy tree. Jobs of a tree run one batch at a time "
+        "and every account shares the company root, so a single worker is run"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--poll-interval", type=float, default=1.0)
+        parser.add_argument("--once", action="store_true", help="Exit once no job can be claimed")
+
+    def handle(self, *args, **options):
+        processed = 0
+        while True:
+            # When draining once there is nothing to wait for, so jobs are not held back to be coalesced
+            jobs = claim_comp_plan_jobs(coalesce_window=0 if options["once"] else None)
+            if not jobs:
+                if options["once"]:
+                    break
+                time.sleep(options["poll_interval"])
+                continue
+
+            for job in run_comp_plan_jobs(jobs):
+                processed += 1
+                if job.status == CompPlanJobStatus.FAILED:
+                    self.stderr.write("Comp plan job %s failed: %s" % (job.job_id, job.last_error))
+
+        self.stdout.write(self.style.SUCCESS("Processed %s comp plan jobs." % processed))
@@ -0,0 +1,37 @@
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.functions import TruncDate
+from django.core.management.base import BaseCommand
+from tzlocal import get_localzone
+from core.enums import ActivityType, WalletType
+from core.models import Activity, DailySalesMatch
+
+
+class Command(BaseCommand):
+    help = "Recomputes the daily sales match points of every Account from its Activity history"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        sales_matches = (
+            Activity.objects.filter(
+                account__isnull=False,
+                wallet=WalletType.PV_TOTAL_WALLET,
+                activity_type=ActivityType.PV_SALES_MATCH,
+            )
+            .annotate(date=TruncDate("created", tzinfo=get_localzone()))
+            .values("account", "date")
+            .annotate(points=Sum("activity_amount"))
+            .order_by()
+        )
+        daily_sales_matches = [
+            DailySalesMatch(account_id=sales_match["account"], date=sales_match["date"], points=sales_match["points"])
+            for sales_match in sales_matches
+        ]
+
+        with transaction.atomic():
+            DailySalesMatch.objects.all().delete()
+            DailySalesMatch.objects.bulk_create(daily_sales_matches, batch_size=options["batch_size"])
+
+        self.stdout.write(self.style.SUCCESS("Rebuilt %s daily sales matches." % len(daily_sales_matches)))
@@ -0,0 +1,60 @@
+import decimal
+from collections import defaultdict
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.functions import TruncMonth
+from django.core.management.base import BaseCommand
+from tzlocal import get_localzone
+from core.models import (
+    Activity,
+    LeaderboardEntry,
+    add_leaderboard_amount,
+    get_leaderboard_amount,
+    get_leaderboard_period,
+)
+
+
+class Command(BaseCommand):
+    help = "Recomputes the monthly and all time top earners leaderboard of every Account from its Activity history"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        monthly_activities = (
+            Activity.objects.filter(account__isnull=False)
+            .annotate(month=TruncMonth("created", tzinfo=get_localzone()))
+            .values("account", "activity_type", "wallet", "status", "month")
+            .annotate(amount=Sum("activity_amount"))
+            .order_by()
+        )
+        amounts = defaultdict(decimal.Decimal)
+        for monthly_activity in monthly_activities:
+            if not monthly_activity["amount"]:
+                continue
+            amount = get_leaderboard_amount(
+                monthly_activity["activity_type"],
+                monthly_activity["wallet"],
+                monthly_activity["status"],
+                monthly_activity["amount"],
+            )
+            if amount:
+                add_leaderboard_amount(
+                    amounts,
+                    monthly_activity["account"],
+                    monthly_activity["wallet"],
+                    get_leaderboard_period(monthly_activity["month"]),
+                    amount,
+                )
+
+        leaderboard_entries = [
+            LeaderboardEntry(account_id=account_id, wallet=wallet, period=period, amount=amount)
+            for (account_id, wallet, period), amount in amounts.items()
+            if amount
+        ]
+
+        with transaction.atomic():
+            LeaderboardEntry.objects.all().delete()
+            LeaderboardEntry.objects.bulk_create(leaderboard_entries, batch_size=options["batch_size"])
+
+        self.stdout.write(self.style.SUCCESS("Rebuilt %s leaderboard entries." % len(leaderboard_entries)))
@@ -0,0 +1,49 @@
+from django.db import transaction
+from django.db.models import Q, Sum, DecimalField
+from django.db.models.functions import Coalesce
+from django.core.management.base import BaseCommand
+from core.enums import ActivityType
+from core.models import Activity, PointValueBalance, POINT_VALUE_WALLETS
+
+
+class Command(BaseCommand):
+    help = "Recomputes the running point value balance of every Account from its Activity history"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        balances = (
+            Activity.objects.filter(account__isnull=False, wallet__in=POINT_VALUE_WALLETS)
+            .values("account", "wallet")
+            .annotate(
+                balance=Coalesce(Sum("activity_amount"), 0, output_field=DecimalField()),
+                running_total=Coalesce(
+                    Sum("activity_amount", filter=Q(activity_type=ActivityType.DOWNLINE_ENTRY)),
+                    0,
+                    output_field=DecimalField(),
+                ),
+                flushout_total=Coalesce(
+                    Sum("activity_amount", filter=Q(activity_type=ActivityType.FLUSH_OUT_PENALTY)),
+                    0,
+                    output_field=DecimalField(),
+                ),
+            )
+            .order_by()
+        )
+        point_value_balances = [
+            PointValueBalance(
+                account_id=balance["account"],
+                wallet=balance["wallet"],
+                balance=balance["balance"],
+                running_total=balance["running_total"],
+                flushout_total=balance["flushout_total"],
+            )
+            for balance in balances
+        ]
+
+        with transaction.atomic():
+            PointValueBalance.objects.all().delete()
+            PointValueBalance.objects.bulk_create(point_value_balances, batch_size=options["batch_size"])
+
+        self.stdout.write(self.style.SUCCESS("Rebuilt %s point value balances." % len(point_value_balances)))
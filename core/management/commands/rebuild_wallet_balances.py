@@ -0,0 +1,50 @@
+from django.db import transaction
+from django.db.models import Q, Sum, DecimalField
+from django.db.models.functions import Coalesce
+from django.core.management.base import BaseCommand
+from core.enums import ActivityStatus, ActivityType
+from core.models import Activity, WalletBalance, CASHOUT_WALLETS, PENDING_CASHOUT_STATUSES
+
+
+class Command(BaseCommand):
+    help = "Recomputes the available, pending cashout and lifetime earned wallet balances from the Activity history"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        is_cashout = Q(activity_type=ActivityType.CASHOUT)
+        balances = (
+            Activity.objects.filter(account__isnull=False, wallet__in=CASHOUT_WALLETS)
+            .values("account", "wallet")
+            .annotate(
+                lifetime_earned=Coalesce(Sum("activity_amount", filter=~is_cashout), 0, output_field=DecimalField()),
+                spent=Coalesce(
+                    Sum("activity_amount", filter=is_cashout & ~Q(status=ActivityStatus.DENIED)),
+                    0,
+                    output_field=DecimalField(),
+                ),
+                pending_cashout=Coalesce(
+                    Sum("activity_amount", filter=is_cashout & Q(status__in=PENDING_CASHOUT_STATUSES)),
+                    0,
+                    output_field=DecimalField(),
+                ),
+            )
+            .order_by()
+        )
+        wallet_balances = [
+            WalletBalance(
+                account_id=balance["account"],
+                wallet=balance["wallet"],
+                available=balance["lifetime_earned"] - balance["spent"],
+                pending_cashout=balance["pending_cashout"],
+                lifetime_earned=balance["lifetime_earned"],
+            )
+            for balance in balances
+        ]
+
+        with transaction.atomic():
+            WalletBalance.objects.all().delete()
+            WalletBalance.objects.bulk_create(wallet_balances, batch_size=options["batch_size"])
+
+        self.stdout.write(self.style.SUCCESS("Rebuilt %s wallet balances." % len(wallet_balances)))
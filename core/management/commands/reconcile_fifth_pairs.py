@@ -0,0 +1,66 @@
+from django.db import transaction
+from django.db.models import Q, Sum, DecimalField
+from django.db.models.functions import Coalesce
+from django.core.management.base import BaseCommand
+from core.enums import ActivityType, WalletType
+from core.models import Activity, FifthPairProgress
+
+
+class Command(BaseCommand):
+    help = "Verifies the fifth pair progress of every Account against its Activity history"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--fix", action="store_true", help="Rewrite the progress of mismatched accounts")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        totals = (
+            Activity.objects.filter(
+                Q(wallet=WalletType.PV_TOTAL_WALLET)
+                | Q(wallet=WalletType.GC_WALLET, activity_type=ActivityType.FIFTH_PAIR),
+                account__isnull=False,
+            )
+            .values("account")
+            .annotate(
+                matched_pv=Coalesce(
+                    Sum("activity_amount", filter=Q(wallet=WalletType.PV_TOTAL_WALLET)), 0, output_field=DecimalField()
+                ),
+                paid_amount=Coalesce(
+                    Sum("activity_amount", filter=Q(wallet=WalletType.GC_WALLET)), 0, output_field=DecimalField()
+                ),
+            )
+            .order_by()
+        )
+        expected = {total["account"]: (total["matched_pv"], total["paid_amount"]) for total in totals}
+        actual = {
+            progress.account_id: (progress.matched_pv, progress.paid_amount)
+            for progress in FifthPairProgress.objects.all()
+        }
+
+        mismatched = []
+        for account_id in sorted(expected.keys() | actual.keys()):
+            expected_progress = expected.get(account_id, (0, 0))
+            actual_progress = actual.get(account_id, (0, 0))
+            if expected_progress != actual_progress:
+                mismatched.append(account_id)
+                self.stdout.write(
+                    "Account %s: expected matched PV %s and paid %s, found %s and %s"
+                    % (account_id, *expected_progress, *actual_progress)
+                )
+
+        if mismatched and options["fix"]:
+            with transaction.atomic():
+                FifthPairProgress.objects.filter(account__in=mismatched).delete()
+                FifthPairProgress.objects.bulk_create(
+                    [
+                        FifthPairProgress(account_id=account_id, matched_pv=matched_pv, paid_amount=paid_amount)
+                        for account_id, (matched_pv, paid_amount) in expected.items()
+                        if account_id in mismatched
+                    ],
+                    batch_size=options["batch_size"],
+                )
+            self.stdout.write(self.style.SUCCESS("Fixed fifth pair progress of %s accounts." % len(mismatched)))
+        elif mismatched:
+            self.stdout.write(self.style.ERROR("Fifth pair progress of %s accounts is out of sync." % len(mismatched)))
+        else:
+            self.stdout.write(self.style.SUCCESS("Fifth pair progress of %s accounts is in sync." % len(actual)))
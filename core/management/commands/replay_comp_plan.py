@@ -0,0 +1,127 @@
+import csv
+import decimal
+from collections import defaultdict
+from django.db.models import Count, Sum
+from django.core.management.base import BaseCommand, CommandError
+from core.enums import ActivityType
+from core.models import Activity, quantize_activity_amount
+from core.services import CompPlanReplay
+
+COMP_PLAN_ACTIVITY_TYPES = [
+    ActivityType.ENTRY,
+    ActivityType.FRANCHISE_ENTRY,
+    ActivityType.DIRECT_REFERRAL,
+    ActivityType.FRANCHISE_COMMISSION,
+    ActivityType.REFERRAL_BONUS,
+    ActivityType.DOWNLINE_ENTRY,
+    ActivityType.PV_SALES_MATCH,
+    ActivityType.SALES_MATCH,
+    ActivityType.LEADERSHIP_BONUS,
+    ActivityType.FIFTH_PAIR,
+    ActivityType.FLUSH_OUT_PENALTY,
+]
+ACTIVITY_COLUMNS = [
+    "id",
+    "account_id",
+    "activity_type",
+    "activity_amount",
+    "status",
+    "wallet",
+    "content_type_id",
+    "object_id",
+    "created_by_id",
+    "created",
+    "modified",
+    "deleted",
+    "is_deleted",
+    "note",
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Replays the comp plan of the whole tree with the current settings, writing the resulting activities to a "
+        "CSV file that can be bulk loaded into the Activity table and/or reporting how they differ from the ledger"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", help="CSV file to write the replayed activities to")
+        parser.add_argument("--diff", action="store_true", help="Compare replayed totals with the current ledger")
+        parser.add_argument("--limit", type=int, default=100, help="Most differences to print")
+
+    def handle(self, *args, **options):
+        if not options["output"] and not options["diff"]:
+            raise CommandError("Pass --output, --diff or both.")
+
+        totals = defaultdict(lambda: [0, decimal.Decimal(0)])
+        output = open(options["output"], "w", newline="") if options["output"] else None
+        writer = csv.writer(output) if output else None
+        if writer:
+            writer.writerow(ACTIVITY_COLUMNS)
+
+        def write_activity(activity):
+            amount = quantize_activity_amount(activity.activity_amount)
+            total = totals[(activity.account_id, activity.activity_type, activity.wallet)]
+            total[0] += 1
+            total[1] += amount
+            if writer:
+                writer.writerow(
+                    [
+                        activity.pk,
+                        activity.account_id,
+                        activity.activity_type,
+                        amount,
+                        activity.status,
+                        activity.wallet,
+                        activity.content_type_id,
+                        activity.object_id,
+                        activity.created_by_id,
+                        activity.created.isoformat(),
+                        activity.modified.isoformat(),
+                        "",
+                        False,
+                        "",
+                    ]
+                )
+
+        try:
+            events = CompPlanReplay(write_activity).replay()
+        finally:
+            if output:
+                output.close()
+
+        activities = sum(count for count, amount in totals.values())
+        self.stdout.write("Replayed %s events into %s activities." % (events, activities))
+
+        if options["diff"]:
+            self.diff(totals, options["limit"])
+
+    def diff(self, totals=None, limit=None):
+        ledger = {
+            (total["account"], total["activity_type"], total["wallet"]): [
+                total["count"],
+                quantize_activity_amount(total["total"] or 0),
+            ]
+            for total in Activity.objects.filter(activity_type__in=COMP_PLAN_ACTIVITY_TYPES)
+            .values("account", "activity_type", "wallet")
+            .annotate(count=Count("id"), total=Sum("activity_amount"))
+            .order_by()
+        }
+
+        differences = 0
+        keys = sorted(ledger.keys() | totals.keys(), key=lambda key: tuple(str(part) for part in key))
+        for key in keys:
+            ledger_total = ledger.get(key, [0, decimal.Decimal(0)])
+            replay_total = totals.get(key, [0, decimal.Decimal(0)])
+            if ledger_total != replay_total:
+                differences += 1
+                if differences <= limit:
+                    self.stdout.write(
+                        "Account %s %s %s: ledger %s (%s), replay %s (%s)"
+                        % (*key, ledger_total[1], ledger_total[0], replay_total[1], replay_total[0])
+                    )
+
+        if differences:
+            self.stdout.write(self.style.ERROR("%s account totals differ from the ledger." % differences))
+        else:
+            self.stdout.write(self.style.SUCCESS("Replay matches the ledger."))
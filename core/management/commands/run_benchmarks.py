@@ -0,0 +1,79 @@
+import io
+import json
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from accounts.models import Account
+from core.benchmarks import BenchmarkNetwork, compare_benchmark, get_benchmarks, run_benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        "Times registration comp plans, genealogy and wallet endpoints against generated networks of several sizes "
+        "and compares wall time, query count and rows scanned with the stored baseline"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="1000,10000", help="Comma separated network sizes")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--repeat", type=int, default=5, help="Runs per operation, the median time is kept")
+        parser.add_argument("--baseline", default=settings.BENCHMARK_BASELINE, help="Baseline JSON file")
+        parser.add_argument("--save", action="store_true", help="Write the results as the new baseline")
+        parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown before a regression")
+        parser.add_argument("--noise", type=float, default=0.005, help="Seconds of slowdown always allowed")
+
+    def handle(self, *args, **options):
+        if Account.objects.exists():
+            raise CommandError("Benchmarks need an empty database so every run scans the same rows.")
+
+        sizes = [int(size) for size in options["sizes"].split(",")]
+        results = {}
+        for size in sizes:
+            # Every network is generated and benchmarked in a transaction that is rolled back afterwards
+            with transaction.atomic():
+                call_command("generate_network", size, seed=options["seed"], stdout=io.StringIO())
+                network = BenchmarkNetwork()
+                for name, prepare, prepare_options in get_benchmarks(network):
+                    results["%s/%s" % (size, name)] = run_benchmark(
+                        network, prepare, prepare_options, options["repeat"]
+                    )
+                transaction.set_rollback(True)
+
+        if options["save"]:
+            with open(options["baseline"], "w") as baseline_file:
+                json.dump(results, baseline_file, indent=2, sort_keys=True)
+            self.stdout.write(self.style.SUCCESS("Saved %s results to %s." % (len(results), options["baseline"])))
+
+        try:
+            with open(options["baseline"]) as baseline_file:
+                baseline = json.load(baseline_file)
+        except FileNotFoundError:
+            baseline = {}
+
+        regressions = 0
+        self.stdout.write(
+            "%-36s %10s %10s %8s %8s %12s %12s"
+            % ("Benchmark", "Seconds", "Baseline", "Queries", "Base", "Rows", "Base")
+        )
+        for name, result in results.items():
+            expected = baseline.get(name)
+            self.stdout.write(
+                "%-36s %10.4f %10s %8s %8s %12s %12s"
+                % (
+                    name,
+                    result["seconds"],
+                    "%.4f" % expected["seconds"] if expected else "-",
+                    result["queries"],
+                    expected["queries"] if expected else "-",
+                    result["rows_scanned"] if result["rows_scanned"] is not None else "-",
+                    expected.get("rows_scanned") if expected and expected.get("rows_scanned") is not None else "-",
+                )
+            )
+            if expected:
+                for regression in compare_benchmark(result, expected, options["tolerance"], options["noise"]):
+                    regressions += 1
+                    self.stdout.write(self.style.ERROR("  regression: %s" % regression))
+
+        if regressions:
+            raise CommandError("%s regressions against the baseline." % regressions)
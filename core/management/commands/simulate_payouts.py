@@ -0,0 +1,45 @@
+import datetime
+from django.core.management.base import BaseCommand, CommandError
+from core.simulations import SIMULATED_SETTINGS, compare_payouts
+
+
+def parse_assignment(value=None):
+    name, separator, amount = value.partition("=")
+    if not separator:
+        raise CommandError("Expected NAME=VALUE, got %s." % value)
+    return name.strip(), amount.strip()
+
+
+class Command(BaseCommand):
+    help = "Simulates what the comp plan would have paid out with candidate settings and package flush out limits"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--set", action="append", default=[], metavar="SETTING=VALUE", help="Candidate setting value"
+        )
+        parser.add_argument(
+            "--flush-out-limit", action="append", default=[], metavar="PACKAGE_ID=LIMIT", help="Candidate limit"
+        )
+        parser.add_argument("--start", type=datetime.date.fromisoformat, help="First registration date paid out")
+        parser.add_argument("--end", type=datetime.date.fromisoformat, help="Registration date payouts stop at")
+        parser.add_argument("--limit", type=int, default=10, help="Accounts with the largest change to list")
+
+    def handle(self, *args, **options):
+        settings = dict(parse_assignment(value) for value in options["set"])
+        for name in settings:
+            if name not in SIMULATED_SETTINGS:
+                raise CommandError("%s can not be simulated." % name)
+        flush_out_limits = dict(parse_assignment(value) for value in options["flush_out_limit"])
+
+        result = compare_payouts(settings, flush_out_limits, options["start"], options["end"], options["limit"])
+
+        self.stdout.write("%-24s %16s %16s" % ("Payout", "Baseline", "Candidate"))
+        for payout_type, baseline in result["baseline"].items():
+            self.stdout.write("%-24s %16.2f %16.2f" % (payout_type, baseline, result["candidate"][payout_type]))
+        self.stdout.write("%-24s %16.2f %16.2f" % ("TOTAL", result["baseline_total"], result["candidate_total"]))
+        self.stdout.write(
+            "%-24s %16.2f %16.2f"
+            % ("FLUSH_OUT (PV)", result["flush_outs"]["baseline"], result["flush_outs"]["candidate"])
+        )
+        for change in result["top_changes"]:
+            self.stdout.write("Account %s: %+.2f" % (change["account"], change["change"]))
@@ -1,5 +1,9 @@
 import datetime
-from django.db import models
+import decimal
+import uuid
+from collections import defaultdict
+from django.db import models, transaction
+from django.db.models import F
 from django.utils import timezone
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
@@ -8,9 +12,57 @@ from accounts.enums import Gender
 from accounts.models import Account
 from core.enums import CodeType, Settings
 from core.enums import Settings, CodeStatus, CodeType, ActivityType, ActivityStatus, WalletType
+from core.enums import CompPlanJobType, CompPlanJobStatus
+
+
+class VersionedQuerySet(models.QuerySet):
+    def update(self, **kwargs):
+        from core.services import invalidate_snapshots
+
+        kwargs.setdefault("modified", timezone.now())
+        updated = super().update(**kwargs)
+        invalidate_snapshots(self.model)
+        return updated
+
+    def delete(self):
+        from core.services import invalidate_snapshots
+
+        deleted = super().delete()
+        invalidate_snapshots(self.model)
+        return deleted
+
+
+class VersionedModel(models.Model):
+    """
+    Rows cached in-process by core.services snapshots. Saving, updating or deleting them, one at a time or through
+    a queryset, drops the local snapshots of their table and moves the table's version so other processes reload
+    theirs. Raw SQL writes do neither and must touch modified themselves.
+    """
+
+    modified = models.DateTimeField(default=timezone.now)
+
+    objects = VersionedQuerySet.as_manager()
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        from core.services import invalidate_snapshots
+
+        self.modified = timezone.now()
+        super().save(*args, **kwargs)
+        invalidate_snapshots(self.__class__)
+
+    def delete(self, *args, **kwargs):
+        from core.services import invalidate_snapshots
+
+        deleted = super().delete(*args, **kwargs)
+        invalidate_snapshots(self.__class__)
+        return deleted
+
 
 # Core Settings
-class Setting(models.Model):
+class Setting(VersionedModel):
     property = models.CharField(max_length=255, default=None, choices=Settings.choices)
     value = models.DecimalField(default=0, max_length=256, decimal_places=2, max_digits=13, blank=True, null=True)
 
@@ -21,7 +73,7 @@ class Setting(models.Model):
         return "%s - %s" % (self.property, self.value)
 
 
-class Package(models.Model):
+class Package(VersionedModel):
     package_name = models.CharField(max_length=255, null=True, blank=True)
     package_amount = models.DecimalField(
         default=0, max_length=256, decimal_places=2, max_digits=13, blank=True, null=True
@@ -46,7 +98,7 @@ class Package(models.Model):
 
 
 # To be retrieved once Referral Program Count is reached
-class ReferralBonus(models.Model):
+class ReferralBonus(VersionedModel):
     package_referrer = models.ForeignKey(
         Package, on_delete=models.CASCADE, related_name="referral_bonus_package_referrer"
     )
@@ -70,7 +122,7 @@ class ReferralBonus(models.Model):
 
 
 # Real Time Bonus once downline has incurred an Activity
-class LeadershipBonus(models.Model):
+class LeadershipBonus(VersionedModel):
     package = models.ForeignKey(Package, on_delete=models.CASCADE, related_name="leadership_bonus_package")
     level = models.DecimalField(default=0, max_length=256, decimal_places=2, max_digits=13, blank=True, null=True)
     point_value_percentage = models.DecimalField(
@@ -145,7 +197,9 @@ class Code(models.Model):
 
     def get_expiration(self):
         if self.status == CodeStatus.ACTIVE and self.is_expiring == True:
-            code_expiration = int(Setting.objects.get(property=Settings.CODE_EXPIRATION).value)
+            from core.services import get_setting
+
+            code_expiration = get_setting(Settings.CODE_EXPIRATION)
             local_tz = get_localzone()
             modified = self.modified.astimezone(local_tz)
             expiry = modified + datetime.timedelta(hours=code_expiration)
@@ -216,10 +270,36 @@ class Activity(models.Model):
 
     class Meta:
         verbose_name_plural = "Activities"
+        indexes = [models.Index(fields=["created"])]
 
     def __str__(self):
         return "%s : %s : %s - %s" % (self.activity_type, self.wallet, self.activity_amount, self.account)
 
+    def save(self, *args, **kwargs):
+        is_new = self._state.adding
+        if self.activity_amount is not None:
+            self.activity_amount = quantize_activity_amount(self.activity_amount)
+        with transaction.atomic():
+            saved_status = None if is_new else self.get_saved_cashout_status()
+            super().save(*args, **kwargs)
+            if is_new:
+                update_point_value_balances([self])
+                update_daily_sales_matches([self])
+                update_fifth_pair_progress([self])
+                update_wallet_balances([self])
+                update_leaderboard([self])
+            elif saved_status is not None and saved_status != self.status:
+                update_cashout_wallet_balance(self, saved_status)
+                update_cashout_leaderboard(self, saved_status)
+                update_activity_rollup_status(self, saved_status)
+
+    def get_saved_cashout_status(self):
+        # Locks the cashout so concurrent status changes apply their balance transitions one after another
+        if self.activity_type != ActivityType.CASHOUT:
+            return None
+
+        return Activity.objects.select_for_update().filter(pk=self.pk).values_list("status", flat=True).first()
+
     def get_activity_number(self):
         return str(self.id).zfill(7)
 
@@ -266,6 +346,404 @@ class Activity(models.Model):
         return str(self.id).zfill(5)
 
 
+class PointValueBalance(models.Model):
+    account = models.ForeignKey(
+        "accounts.Account",
+        on_delete=models.CASCADE,
+        related_name="point_value_balances",
+    )
+    wallet = models.CharField(max_length=32, choices=WalletType.choices)
+    balance = models.DecimalField(default=0, decimal_places=2, max_digits=13)
+    running_total = models.DecimalField(default=0, decimal_places=2, max_digits=13)
+    flushout_total = models.DecimalField(default=0, decimal_places=2, max_digits=13)
+    modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("account", "wallet")
+
+    def __str__(self):
+        return "%s : %s - %s" % (self.wallet, self.balance, self.account)
+
+
+class DailySalesMatch(models.Model):
+    account = models.ForeignKey(
+        "accounts.Account",
+        on_delete=models.CASCADE,
+        related_name="daily_sales_matches",
+    )
+    date = models.DateField()
+    points = models.DecimalField(default=0, decimal_places=2, max_digits=13)
+
+    class Meta:
+        unique_together = ("account", "date")
+
+    def __str__(self):
+        return "%s : %s - %s" % (self.date, self.points, self.account)
+
+
+class FifthPairProgress(models.Model):
+    account = models.OneToOneField(
+        "accounts.Account",
+        on_delete=models.CASCADE,
+        related_name="fifth_pair_progress",
+    )
+    # Lifetime PV_TOTAL_WALLET points and GC_WALLET fifth pair amount, so the PV matched since the last fifth pair
+    # is derived without re-aggregating Activity
+    matched_pv = models.DecimalField(default=0, decimal_places=2, max_digits=13)
+    paid_amount = models.DecimalField(default=0, decimal_places=2, max_digits=13)
+    modified = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "%s : %s - %s" % (self.matched_pv, self.paid_amount, self.account)
+
+    def get_unpaid_pv(self, fifth_pair_percentage=None, pv_conversion=None):
+        return self.matched_pv - (self.paid_amount / pv_conversion / fifth_pair_percentage)
+
+
+class WalletBalance(models.Model):
+    account = models.ForeignKey(
+        "accounts.Account",
+        on_delete=models.CASCADE,
+        related_name="wallet_balances",
+    )
+    wallet = models.CharField(max_length=32, choices=WalletType.choices)
+    # Earnings less every cashout that was not denied, the amount a new cashout may take
+    available = models.DecimalField(default=0, decimal_places=2, max_digits=13)
+    pending_cashout = models.DecimalField(default=0, decimal_places=2, max_digits=13)
+    lifetime_earned = models.DecimalField(default=0, decimal_places=2, max_digits=13)
+    modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("account", "wallet")
+
+    def __str__(self):
+        return "%s : %s - %s" % (self.wallet, self.available, self.account)
+
+
+class LeaderboardEntry(models.Model):
+    """
+    Net balance of an account per cashout wallet and per calendar month, with ALL_WALLETS and ALL_TIME rows holding
+    the totals so every top earners ranking is an index range read. See get_leaderboard_amount.
+    """
+
+    ALL_WALLETS = ""
+    ALL_TIME = ""
+
+    account = models.ForeignKey(
+        "accounts.Account",
+        on_delete=models.CASCADE,
+        related_name="leaderboard_entries",
+    )
+    wallet = models.CharField(max_length=32, choices=WalletType.choices, blank=True)
+    period = models.CharField(max_length=7, blank=True)
+    amount = models.DecimalField(default=0, decimal_places=2, max_digits=13)
+    modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("account", "wallet", "period")
+        indexes = [models.Index(fields=["wallet", "period", "-amount"])]
+
+    def __str__(self):
+        return "%s %s : %s - %s" % (self.wallet or "ALL", self.period or "ALL", self.amount, self.account)
+
+
+class ActivityDailyRollup(models.Model):
+    """
+    Activity counts and amounts per local day, activity type, wallet and status, written by the
+    RollupDailyActivities cron for every day before today. A missing activity type or wallet is stored blank.
+    """
+
+    date = models.DateField()
+    activity_type = models.CharField(max_length=32, choices=ActivityType.choices, blank=True)
+    wallet = models.CharField(max_length=32, choices=WalletType.choices, blank=True)
+    status = models.CharField(max_length=32, choices=ActivityStatus.choices)
+    count = models.PositiveIntegerField(default=0)
+    amount = models.DecimalField(default=0, decimal_places=2, max_digits=15)
+    modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = "activity_daily_rollup"
+        unique_together = ("date", "activity_type", "wallet", "status")
+
+    def __str__(self):
+        return "%s %s : %s - %s (%s)" % (self.date, self.activity_type, self.wallet, self.amount, self.count)
+
+
+class AccountActivityDailyRollup(models.Model):
+    """
+    ActivityDailyRollup per account, for the activities of the time series metrics only.
+    """
+
+    date = models.DateField()
+    account = models.ForeignKey(
+        "accounts.Account",
+        on_delete=models.CASCADE,
+        related_name="activity_daily_rollups",
+    )
+    activity_type = models.CharField(max_length=32, choices=ActivityType.choices, blank=True)
+    wallet = models.CharField(max_length=32, choices=WalletType.choices, blank=True)
+    status = models.CharField(max_length=32, choices=ActivityStatus.choices)
+    count = models.PositiveIntegerField(default=0)
+    amount = models.DecimalField(default=0, decimal_places=2, max_digits=15)
+    modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = "account_activity_daily_rollup"
+        unique_together = ("account", "date", "activity_type", "wallet", "status")
+
+    def __str__(self):
+        return "%s %s %s : %s - %s (%s)" % (
+            self.date,
+            self.account_id,
+            self.activity_type,
+            self.wallet,
+            self.amount,
+            self.count,
+        )
+
+
+POINT_VALUE_WALLETS = [WalletType.PV_LEFT_WALLET, WalletType.PV_RIGHT_WALLET, WalletType.PV_TOTAL_WALLET]
+
+
+def quantize_activity_amount(amount):
+    # Rounds half away from zero like a PostgreSQL numeric column, activities are stored already rounded so the
+    # running balances add up exactly what the ledger holds on every database
+    field = Activity._meta.get_field("activity_amount")
+    return field.to_python(amount).quantize(decimal.Decimal(1).scaleb(-field.decimal_places), decimal.ROUND_HALF_UP)
+
+
+def increment_row(model=None, key=None, **amounts):
+    # Concurrent first increments of a row both insert it, the loser is ignored and both then increment
+    rows = model.objects.filter(**key)
+    increments = {field: F(field) + amount for field, amount in amounts.items()}
+    if not rows.update(**increments):
+        model.objects.bulk_create([model(**key)], ignore_conflicts=True)
+        rows.update(**increments)
+
+
+def update_point_value_balances(activities):
+    balances = defaultdict(lambda: [decimal.Decimal(0)] * 3)
+    for activity in activities:
+        if activity.account_id and activity.wallet in POINT_VALUE_WALLETS and activity.activity_amount:
+            amount = quantize_activity_amount(activity.activity_amount)
+            balance = balances[(activity.account_id, activity.wallet)]
+            balance[0] += amount
+            if activity.activity_type == ActivityType.DOWNLINE_ENTRY:
+                balance[1] += amount
+            elif activity.activity_type == ActivityType.FLUSH_OUT_PENALTY:
+                balance[2] += amount
+
+    for (account_id, wallet), (amount, running_amount, flushout_amount) in balances.items():
+        increment_row(
+            PointValueBalance,
+            {"account_id": account_id, "wallet": wallet},
+            balance=amount,
+            running_total=running_amount,
+            flushout_total=flushout_amount,
+        )
+
+
+def get_sales_match_date(activity):
+    return timezone.localtime(activity.created, get_localzone()).date()
+
+
+def update_daily_sales_matches(activities):
+    sales_matches = defaultdict(decimal.Decimal)
+    for activity in activities:
+        if (
+            activity.account_id
+            and activity.wallet == WalletType.PV_TOTAL_WALLET
+            and activity.activity_type == ActivityType.PV_SALES_MATCH
+            and activity.activity_amount
+        ):
+            sales_matches[(activity.account_id, get_sales_match_date(activity))] += quantize_activity_amount(
+                activity.activity_amount
+            )
+
+    for (account_id, date), points in sales_matches.items():
+        increment_row(DailySalesMatch, {"account_id": account_id, "date": date}, points=points)
+
+
+def update_fifth_pair_progress(activities):
+    progress = defaultdict(lambda: [decimal.Decimal(0)] * 2)
+    for activity in activities:
+        if not activity.account_id or not activity.activity_amount:
+            continue
+        if activity.wallet == WalletType.PV_TOTAL_WALLET:
+            progress[activity.account_id][0] += quantize_activity_amount(activity.activity_amount)
+        elif activity.wallet == WalletType.GC_WALLET and activity.activity_type == ActivityType.FIFTH_PAIR:
+            progress[activity.account_id][1] += quantize_activity_amount(activity.activity_amount)
+
+    for account_id, (matched_pv, paid_amount) in progress.items():
+        increment_row(FifthPairProgress, {"account_id": account_id}, matched_pv=matched_pv, paid_amount=paid_amount)
+
+
+CASHOUT_WALLETS = [WalletType.B_WALLET, WalletType.F_WALLET, WalletType.GC_WALLET]
+PENDING_CASHOUT_STATUSES = [ActivityStatus.REQUESTED, ActivityStatus.APPROVED]
+
+
+def get_cashout_effect(status=None, amount=None):
+    # Amounts a cashout in this status holds as pending and takes out of the available balance
+    if status == ActivityStatus.DENIED:
+        return 0, 0
+    if status in PENDING_CASHOUT_STATUSES:
+        return amount, amount
+    return 0, amount
+
+
+def update_wallet_balance(account_id=None, wallet=None, available=0, pending_cashout=0, lifetime_earned=0):
+    increment_row(
+        WalletBalance,
+        {"account_id": account_id, "wallet": wallet},
+        available=available,
+        pending_cashout=pending_cashout,
+        lifetime_earned=lifetime_earned,
+    )
+
+
+def update_wallet_balances(activities):
+    balances = defaultdict(lambda: [decimal.Decimal(0)] * 3)
+    for activity in activities:
+        if activity.account_id and activity.wallet in CASHOUT_WALLETS and activity.activity_amount:
+            amount = quantize_activity_amount(activity.activity_amount)
+            balance = balances[(activity.account_id, activity.wallet)]
+            if activity.activity_type == ActivityType.CASHOUT:
+                pending_cashout, spent = get_cashout_effect(activity.status, amount)
+                balance[0] -= spent
+                balance[1] += pending_cashout
+            else:
+                balance[0] += amount
+                balance[2] += amount
+
+    for (account_id, wallet), (available, pending_cashout, lifetime_earned) in balances.items():
+        update_wallet_balance(account_id, wallet, available, pending_cashout, lifetime_earned)
+
+
+def update_cashout_wallet_balance(cashout=None, saved_status=None):
+    if not cashout.account_id or cashout.wallet not in CASHOUT_WALLETS or not cashout.activity_amount:
+        return
+
+    amount = quantize_activity_amount(cashout.activity_amount)
+    saved_pending_cashout, saved_spent = get_cashout_effect(saved_status, amount)
+    pending_cashout, spent = get_cashout_effect(cashout.status, amount)
+    update_wallet_balance(
+        cashout.account_id,
+        cashout.wallet,
+        available=saved_spent - spent,
+        pending_cashout=pending_cashout - saved_pending_cashout,
+    )
+
+
+def get_leaderboard_period(date=None):
+    return date.strftime("%Y-%m")
+
+
+def get_leaderboard_amount(activity_type=None, wallet=None, status=None, amount=None):
+    # Top earners rank the net balance outside the company wallet: every activity there less the cashouts that were
+    # not denied
+    if activity_type == ActivityType.CASHOUT:
+        return 0 if status == ActivityStatus.DENIED else -amount
+    if wallet == WalletType.C_WALLET:
+        return 0
+    return amount
+
+
+def add_leaderboard_amount(amounts=None, account_id=None, wallet=None, period=None, amount=None):
+    # Only the cashout wallets are ranked on their own, every wallet counts towards the ALL_WALLETS entries
+    wallets = [wallet, LeaderboardEntry.ALL_WALLETS] if wallet in CASHOUT_WALLETS else [LeaderboardEntry.ALL_WALLETS]
+    for entry_wallet in wallets:
+        for entry_period in (period, LeaderboardEntry.ALL_TIME):
+            amounts[(account_id, entry_wallet, entry_period)] += amount
+
+
+def get_activity_leaderboard_period(activity=None):
+    return get_leaderboard_period(timezone.localtime(activity.created, get_localzone()).date())
+
+
+def update_leaderboard(activities):
+    amounts = defaultdict(decimal.Decimal)
+    for activity in activities:
+        if not activity.account_id or not activity.activity_amount:
+            continue
+        amount = get_leaderboard_amount(
+            activity.activity_type,
+            activity.wallet,
+            activity.status,
+            quantize_activity_amount(activity.activity_amount),
+        )
+        if amount:
+            add_leaderboard_amount(
+                amounts, activity.account_id, activity.wallet, get_activity_leaderboard_period(activity), amount
+            )
+
+    update_leaderboard_entries(amounts)
+
+
+def update_cashout_leaderboard(cashout=None, saved_status=None):
+    if not cashout.account_id or not cashout.activity_amount:
+        return
+
+    amount = quantize_activity_amount(cashout.activity_amount)
+    amounts = defaultdict(decimal.Decimal)
+    add_leaderboard_amount(
+        amounts,
+        cashout.account_id,
+        cashout.wallet,
+        get_activity_leaderboard_period(cashout),
+        get_leaderboard_amount(cashout.activity_type, cashout.wallet, cashout.status, amount)
+        - get_leaderboard_amount(cashout.activity_type, cashout.wallet, saved_status, amount),
+    )
+    update_leaderboard_entries({key: amount for key, amount in amounts.items() if amount})
+
+
+def update_leaderboard_entries(amounts=None):
+    if not amounts:
+        return
+
+    # A registration pays most of its upline, so the entries are inserted, locked and written in bulk instead of one
+    # update per entry. Concurrent inserts of the same new entry are ignored, the entry is then locked by both
+    LeaderboardEntry.objects.bulk_create(
+        [
+            LeaderboardEntry(account_id=account_id, wallet=wallet, period=period)
+            for account_id, wallet, period in amounts
+        ],
+        ignore_conflicts=True,
+    )
+    account_ids = {account_id for account_id, wallet, period in amounts}
+    entries = [
+        entry
+        for entry in LeaderboardEntry.objects.select_for_update()
+        .filter(account_id__in=account_ids, period__in={period for _, _, period in amounts})
+        .order_by("pk")
+        if (entry.account_id, entry.wallet, entry.period) in amounts
+    ]
+    modified = timezone.now()
+    for entry in entries:
+        entry.amount += amounts[(entry.account_id, entry.wallet, entry.period)]
+        entry.modified = modified
+
+    LeaderboardEntry.objects.bulk_update(entries, ["amount", "modified"])
+
+
+def update_activity_rollup_status(activity=None, saved_status=None):
+    # Moves an activity whose day is already rolled up to the rollups of its new status
+    amount = quantize_activity_amount(activity.activity_amount or 0)
+    key = {
+        "date": timezone.localtime(activity.created, get_localzone()).date(),
+        "activity_type": activity.activity_type or "",
+        "wallet": activity.wallet or "",
+    }
+    for model, model_key in [
+        (ActivityDailyRollup, key),
+        (AccountActivityDailyRollup, dict(key, account_id=activity.account_id)),
+    ]:
+        rollups = model.objects.filter(**model_key)
+        if not rollups.filter(status=saved_status).update(count=F("count") - 1, amount=F("amount") - amount):
+            continue
+
+        increment_row(model, dict(model_key, status=activity.status), count=1, amount=amount)
+
+
 class ActivityDetails(models.Model):
     activity = models.ForeignKey(Activity, on_delete=models.CASCADE, related_name="details")
     action = models.CharField(
@@ -340,3 +818,52 @@ class Franchisee(models.Model):
 
     def __str__(self):
         return "%s" % (self.get_full_name())
+
+
+class CompPlanJob(models.Model):
+    job_id = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
+    job_type = models.CharField(max_length=32, choices=CompPlanJobType.choices, default=CompPlanJobType.CREATE)
+    account = models.ForeignKey(
+        "accounts.Account",
+        on_delete=models.CASCADE,
+        related_name="comp_plan_jobs",
+    )
+    # Jobs sharing a root share ancestors, so they are applied one at a time in queue order
+    tree_root = models.ForeignKey(
+        "accounts.Account",
+        on_delete=models.CASCADE,
+        related_name="tree_comp_plan_jobs",
+    )
+    package = models.ForeignKey(
+        "core.Package",
+        on_delete=models.SET_NULL,
+        related_name="comp_plan_jobs",
+        null=True,
+    )
+    code = models.ForeignKey(
+        "core.Code",
+        on_delete=models.SET_NULL,
+        related_name="comp_plan_jobs",
+        null=True,
+    )
+    status = models.CharField(
+        max_length=32, choices=CompPlanJobStatus.choices, default=CompPlanJobStatus.PENDING, db_index=True
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(null=True, blank=True)
+    available = models.DateTimeField(default=timezone.now)
+    started = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+    created_by = models.ForeignKey(
+        "users.User",
+        on_delete=models.SET_NULL,
+        related_name="created_comp_plan_job",
+        null=True,
+    )
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["id"]
+
+    def __str__(self):
+        return "%s : %s - %s" % (self.job_type, self.status, self.account)
@@ -10,6 +10,7 @@ from core.models import (
     Code,
     Activity,
     ActivityDetails,
+    CompPlanJob,
 )
 from core.services import generate_code, get_cashout_total_tax
 from accounts.models import Account, CashoutMethod
@@ -300,3 +301,22 @@ class CreateFranchiseeSerializer(ModelSerializer):
     class Meta:
         model = Franchisee
         fields = "__all__"
+
+
+# Comp Plan Jobs
+class CompPlanJobSerializer(ModelSerializer):
+    account_number = serializers.CharField(source="account.get_account_number", required=False)
+
+    class Meta:
+        model = CompPlanJob
+        fields = [
+            "job_id",
+            "job_type",
+            "status",
+            "attempts",
+            "last_error",
+            "account_number",
+            "created",
+            "started",
+            "finished",
+        ]
@@ -1,20 +1,52 @@
+import abc
 import decimal
 import logging
 import calendar
 import string, random
+import time
+import datetime
+import functools
+import itertools
+import operator
+from array import array
+from collections import defaultdict
 from django.conf import settings
 from django.core.mail import EmailMessage
 from django.db.models.functions import TruncDate, Coalesce
+from django.contrib.auth.models import AnonymousUser
 from django.contrib.contenttypes.models import ContentType
-from django.db.models import Q, Sum, Case, When, F, DecimalField
+from django.db import transaction, connection, OperationalError
+from django.db.models import Q, Sum, Case, When, F, DecimalField, Count, Max, Min
 from django.utils import timezone
 from django.shortcuts import get_object_or_404
 from tzlocal import get_localzone
 
 # from accounts.models import Account
 from accounts.enums import ParentSide, Gender
-from core.models import Activity, Setting, Code, Package, ReferralBonus, LeadershipBonus
-from core.enums import ActivityType, ActivityStatus, WalletType, Settings, CodeStatus, CodeType
+from core.models import (
+    Activity,
+    ActivityDailyRollup,
+    AccountActivityDailyRollup,
+    CASHOUT_WALLETS,
+    Setting,
+    Code,
+    Package,
+    ReferralBonus,
+    LeadershipBonus,
+    PointValueBalance,
+    POINT_VALUE_WALLETS,
+    DailySalesMatch,
+    FifthPairProgress,
+    quantize_activity_amount,
+    update_point_value_balances,
+    update_daily_sales_matches,
+    update_fifth_pair_progress,
+    update_wallet_balances,
+    update_leaderboard,
+    CompPlanJob,
+)
+from core.enums import ActivityType, ActivityStatus, WalletType, Settings, CodeStatus, CodeType, TimeSeriesMetric
+from core.enums import CompPlanJobType, CompPlanJobStatus, TimeSeriesBucket
 
 logger = logging.getLogger("ocmLogger")
 
@@ -74,7 +106,90 @@ def get_settings():
 
 
 def get_setting(property):
-    return Setting.objects.get(property=property).value
+    return get_settings_snapshot().get(property)
+
+
+SETTING_TYPES = {
+    Settings.CODE_EXPIRATION: int,
+    Settings.REFERRAL_BONUS_COUNT: int,
+    Settings.B_WALLET_CASHOUT_DAY: int,
+    Settings.B_WALLET_CASHOUT_OVERRIDE: bool,
+    Settings.F_WALLET_CASHOUT_DAY: int,
+    Settings.F_WALLET_CASHOUT_OVERRIDE: bool,
+    Settings.GC_WALLET_CASHOUT_DAY: int,
+    Settings.GC_WALLET_CASHOUT_OVERRIDE: bool,
+    Settings.MAX_USER_ACCOUNT_LIMIT: int,
+    Settings.CODE_LENGTH: int,
+}
+
+
+def get_models_version(models=None):
+    versions = []
+    for model in models:
+        version = model.objects.aggregate(count=Count("id"), modified=Max("modified"))
+        versions.append((version["count"], version["modified"]))
+    return tuple(versions)
+
+
+class Snapshot(abc.ABC):
+    """
+    In-process copy of one or more tables as of one version of them. The version changes whenever a row is
+    saved, updated or deleted, so a caller holding a snapshot sees one consistent set of values.
+    """
+
+    models = []
+
+    def __init__(self):
+        self.version = get_models_version(self.models)
+        self.checked = time.monotonic()
+        self.load()
+
+    @abc.abstractmethod
+    def load(self):
+        pass
+
+
+class SettingsSnapshot(Snapshot):
+    models = [Setting]
+
+    def load(self):
+        self.values = {}
+        for property, value in Setting.objects.values_list("property", "value"):
+            setting_type = SETTING_TYPES.get(property)
+            self.values[property] = setting_type(int(value)) if setting_type and value is not None else value
+
+    def get(self, property):
+        if property not in self.values:
+            raise Setting.DoesNotExist("Setting %s does not exist." % property)
+        return self.values[property]
+
+
+snapshots = {}
+
+
+def get_snapshot(snapshot_class=None):
+    snapshot = snapshots.get(snapshot_class)
+    # Other processes' changes are picked up by comparing versions, at most once per timeout
+    if snapshot is not None and time.monotonic() - snapshot.checked < settings.SNAPSHOT_TIMEOUT:
+        return snapshot
+
+    if snapshot is None or snapshot.version != get_models_version(snapshot_class.models):
+        snapshot = snapshot_class()
+        snapshots[snapshot_class] = snapshot
+    else:
+        snapshot.checked = time.monotonic()
+
+    return snapshot
+
+
+def invalidate_snapshots(model=None):
+    for snapshot_class in list(snapshots):
+        if model in snapshot_class.models:
+            snapshots.pop(snapshot_class, None)
+
+
+def get_settings_snapshot():
+    return get_snapshot(SettingsSnapshot)
 
 
 def generate_code():
@@ -151,6 +266,228 @@ def check_if_has_pending_cashout(account_id, wallet):
     )
 
 
+def get_wallet_summaries(activities=None, wallets=None, deduction_type=ActivityType.CASHOUT, deduction_name="cashout"):
+    rows = (
+        activities.filter(wallet__in=wallets)
+        .values("wallet", "activity_type")
+        .annotate(
+            amount=Coalesce(Sum("activity_amount"), 0, output_field=DecimalField()),
+            counted_amount=Coalesce(
+                Sum("activity_amount", filter=~Q(status=ActivityStatus.DENIED)), 0, output_field=DecimalField()
+            ),
+        )
+        .order_by()
+    )
+    return summarize_wallets(rows, wallets, deduction_type, deduction_name)
+
+
+def summarize_wallets(rows=None, wallets=None, deduction_type=ActivityType.CASHOUT, deduction_name="cashout"):
+    """
+    Builds wallet summaries from amounts grouped by wallet and activity type, with counted_amount leaving out denied
+    cashouts. Every wallet gets its running total of earnings, its total less the deductions (cashouts that were not
+    denied, or payouts) and its deductions, with the per activity type breakdown in details.
+    """
+    summaries = {
+        wallet: {"running_total": decimal.Decimal(0), "total": decimal.Decimal(0), deduction_name: decimal.Decimal(0)}
+        for wallet in wallets
+    }
+    details = defaultdict(list)
+    for row in rows:
+        if row["wallet"] not in summaries:
+            continue
+        summary = summaries[row["wallet"]]
+        if row["activity_type"] == deduction_type:
+            activity_total = 0 - row["counted_amount"]
+            summary[deduction_name] -= row["amount"]
+            detail = {
+                "running_total": None,
+                "activity_total": activity_total,
+                deduction_name + "_total": -row["amount"],
+            }
+        else:
+            activity_total = row["amount"]
+            summary["running_total"] += row["amount"]
+            detail = {"running_total": row["amount"], "activity_total": activity_total, deduction_name + "_total": None}
+        summary["total"] += activity_total
+        details[row["wallet"]].append({"activity_type": row["activity_type"], **detail})
+
+    for wallet, summary in summaries.items():
+        summary["details"] = sorted(details[wallet], key=lambda detail: detail["activity_total"], reverse=True)
+    return summaries
+
+
+# Activity Rollups
+TIME_SERIES_METRICS = {
+    TimeSeriesMetric.EARNINGS: Q(wallet__in=CASHOUT_WALLETS) & ~Q(activity_type=ActivityType.CASHOUT),
+    TimeSeriesMetric.ENTRIES: Q(activity_type=ActivityType.ENTRY),
+    TimeSeriesMetric.CASHOUTS: Q(activity_type=ActivityType.CASHOUT) & ~Q(status=ActivityStatus.DENIED),
+    # Every flush out penalizes both point value wallets, it is counted once from the left one
+    TimeSeriesMetric.FLUSH_OUTS: Q(activity_type=ActivityType.FLUSH_OUT_PENALTY, wallet=WalletType.PV_LEFT_WALLET),
+}
+
+
+def get_start_of_local_day(date=None):
+    return timezone.make_aware(datetime.datetime.combine(date, datetime.time()), get_localzone())
+
+
+def get_activity_rollup_date(model=None):
+    return (model or ActivityDailyRollup).objects.aggregate(date=Max("date"))["date"]
+
+
+def rollup_daily_activities(lookback_days=None, start=None):
+    """
+    Rolls up every day from the last rolled up one up to yesterday, company wide and per account for the activities
+    of the time series metrics. The last lookback_days rolled up days are rolled up again, which picks up activities
+    committed while they were being rolled up the last time. Every day from start on is rolled up again when given.
+    """
+    lookback_days = settings.ACTIVITY_ROLLUP_LOOKBACK_DAYS if lookback_days is None else lookback_days
+    time_series_activities = functools.reduce(operator.or_, TIME_SERIES_METRICS.values())
+
+    return rollup_activities(
+        ActivityDailyRollup, Activity.objects.all(), ["activity_type", "wallet", "status"], lookback_days, start
+    ) + rollup_activities(
+        AccountActivityDailyRollup,
+        Activity.objects.filter(time_series_activities, account__isnull=False),
+        ["account", "activity_type", "wallet", "status"],
+        lookback_days,
+        start,
+    )
+
+
+def rollup_activities(model=None, activities=None, dimensions=None, lookback_days=None, start=None):
+    today = timezone.localdate(timezone=get_localzone())
+    rolled_up_date = get_activity_rollup_date(model) if start is None else None
+    if rolled_up_date is not None:
+        start = rolled_up_date - datetime.timedelta(days=lookback_days - 1)
+    elif start is None:
+        first_created = activities.aggregate(created=Min("created"))["created"]
+        if first_created is None:
+            return 0
+        start = timezone.localtime(first_created, get_localzone()).date()
+    if start >= today:
+        return 0
+
+    rows = (
+        activities.filter(created__gte=get_start_of_local_day(start), created__lt=get_start_of_local_day(today))
+        .annotate(date=TruncDate("created", tzinfo=get_localzone()))
+        .values("date", *dimensions)
+        .annotate(count=Count("id"), amount=Coalesce(Sum("activity_amount"), 0, output_field=DecimalField()))
+        .order_by()
+    )
+    attnames = {dimension: model._meta.get_field(dimension).attname for dimension in dimensions}
+    rollups = [
+        model(
+            date=row["date"],
+            count=row["count"],
+            amount=row["amount"],
+            **{
+                attname: row[dimension] if row[dimension] is not None else "" for dimension, attname in attnames.items()
+            },
+        )
+        for row in rows
+    ]
+    with transaction.atomic():
+        model.objects.filter(date__gte=start).delete()
+        model.objects.bulk_create(rollups)
+
+    return len(rollups)
+
+
+def get_activity_totals(dimensions=None, **filters):
+    """
+    Counts and sums activities matching filters per dimensions (activity_type, wallet and/or status) from the daily
+    rollups plus the activities created since the last rolled up day. counted_amount leaves out denied activities.
+    A missing activity type or wallet is grouped as blank.
+    """
+    not_denied = ~Q(status=ActivityStatus.DENIED)
+    rollups = (
+        ActivityDailyRollup.objects.filter(**filters)
+        .values(*dimensions)
+        .annotate(
+            total_count=Sum("count"),
+            total_amount=Sum("amount"),
+            total_counted_amount=Coalesce(Sum("amount", filter=not_denied), 0, output_field=DecimalField()),
+        )
+        .order_by()
+    )
+    activities = Activity.objects.filter(**filters)
+    rolled_up_date = get_activity_rollup_date()
+    if rolled_up_date is not None:
+        activities = activities.filter(created__gte=get_start_of_local_day(rolled_up_date + datetime.timedelta(days=1)))
+    activities = (
+        activities.values(*dimensions)
+        .annotate(
+            total_count=Count("id"),
+            total_amount=Coalesce(Sum("activity_amount"), 0, output_field=DecimalField()),
+            total_counted_amount=Coalesce(Sum("activity_amount", filter=not_denied), 0, output_field=DecimalField()),
+        )
+        .order_by()
+    )
+
+    totals = defaultdict(lambda: {"count": 0, "amount": decimal.Decimal(0), "counted_amount": decimal.Decimal(0)})
+    for row in itertools.chain(rollups, activities):
+        total = totals[tuple(row[dimension] or "" for dimension in dimensions)]
+        for field in total:
+            total[field] += row["total_" + field]
+
+    return [dict(zip(dimensions, key), **total) for key, total in totals.items()]
+
+
+def get_time_series_bucket(date=None, bucket=None):
+    if bucket == TimeSeriesBucket.WEEK:
+        return date - datetime.timedelta(days=date.weekday())
+    if bucket == TimeSeriesBucket.MONTH:
+        return date.replace(day=1)
+    return date
+
+
+def get_activity_time_series(metric=None, bucket=None, start=None, end=None, account=None):
+    """
+    Counts and sums the activities of metric from start to end, both included, per day, week (starting on Monday) or
+    month, from the daily rollups plus the activities created since the last rolled up day. Buckets without
+    activities are returned with zeros.
+    """
+    if account is not None:
+        model, filters = AccountActivityDailyRollup, {"account": account}
+    else:
+        model, filters = ActivityDailyRollup, {}
+
+    rollups = (
+        model.objects.filter(TIME_SERIES_METRICS[metric], date__gte=start, date__lte=end, **filters)
+        .values("date")
+        .annotate(total_count=Sum("count"), total_amount=Sum("amount"))
+        .order_by()
+    )
+    activities = Activity.objects.filter(
+        TIME_SERIES_METRICS[metric], created__lt=get_start_of_local_day(end + datetime.timedelta(days=1)), **filters
+    )
+    rolled_up_date = get_activity_rollup_date(model)
+    activities_start = max(start, rolled_up_date + datetime.timedelta(days=1)) if rolled_up_date is not None else start
+    activities = (
+        activities.filter(created__gte=get_start_of_local_day(activities_start))
+        .annotate(date=TruncDate("created", tzinfo=get_localzone()))
+        .values("date")
+        .annotate(
+            total_count=Count("id"), total_amount=Coalesce(Sum("activity_amount"), 0, output_field=DecimalField())
+        )
+        .order_by()
+    )
+    if rolled_up_date is not None:
+        rollups = rollups.filter(date__lte=rolled_up_date)
+
+    series = {}
+    date = start
+    while date <= end:
+        series.setdefault(get_time_series_bucket(date, bucket), {"count": 0, "amount": decimal.Decimal(0)})
+        date += datetime.timedelta(days=1)
+    for row in itertools.chain(rollups, activities):
+        total = series[get_time_series_bucket(row["date"], bucket)]
+        total["count"] += row["total_count"]
+        total["amount"] += row["total_amount"]
+
+    return [dict(bucket=date, **total) for date, total in series.items()]
+
+
 def compute_cashout_total(request):
     data = {}
     admin_fee = get_cashout_total_tax()
@@ -233,16 +570,67 @@ def verify_code_details(request):
             return False, "Code is no longer active.", activation_code, package
 
 
+COMP_PLAN_CONTENT_TYPES = ["account", "activity", "cashoutmethod", "franchisee"]
+
+
+class CompPlanRules(Snapshot):
+    models = [Package, ReferralBonus, LeadershipBonus]
+
+    def load(self):
+        self.packages = Package.objects.in_bulk()
+        self.referral_bonuses = {}
+        for referral_bonus in ReferralBonus.objects.order_by("id"):
+            self.referral_bonuses.setdefault(
+                (referral_bonus.package_referrer_id, referral_bonus.package_referred_id), referral_bonus
+            )
+        self.leadership_bonuses = {}
+        for leadership_bonus in LeadershipBonus.objects.order_by("id"):
+            self.leadership_bonuses.setdefault((leadership_bonus.package_id, leadership_bonus.level), leadership_bonus)
+        self.leadership_levels = int(max((level for package_id, level in self.leadership_bonuses), default=0))
+        self.content_types = {
+            content_type.model: content_type
+            for content_type in ContentType.objects.filter(model__in=COMP_PLAN_CONTENT_TYPES)
+        }
+
+    def get_referral_bonus(self, package_referrer=None, package_referred=None):
+        if package_referrer is None or package_referred is None:
+            return None
+        return self.referral_bonuses.get((package_referrer.pk, package_referred.pk))
+
+    def get_leadership_bonus(self, package=None, level=None):
+        if package is None:
+            return None
+        return self.leadership_bonuses.get((package.pk, level))
+
+
+def get_comp_plan_rules():
+    return get_snapshot(CompPlanRules)
+
+
+def get_content_type(model=None):
+    content_type = get_comp_plan_rules().content_types.get(model)
+    if content_type is None:
+        return ContentType.objects.get(model=model)
+    return content_type
+
+
 def get_package_details(package=None):
-    return get_object_or_404(Package, id=package.pk)
+    package_details = get_comp_plan_rules().packages.get(package.pk)
+    if package_details is None:
+        return get_object_or_404(Package, id=package.pk)
+    return package_details
 
 
 def get_referral_bonus_details(package_referrer=None, package_referred=None):
-    return get_object_or_none(ReferralBonus, package_referrer=package_referrer, package_referred=package_referred)
+    return get_comp_plan_rules().get_referral_bonus(package_referrer, package_referred)
 
 
 def get_leadership_bonus_details(package=None, level=None):
-    return get_object_or_none(LeadershipBonus, package=package, level=level)
+    return get_comp_plan_rules().get_leadership_bonus(package, level)
+
+
+def get_leadership_bonus_levels():
+    return get_comp_plan_rules().leadership_levels
 
 
 def create_activity(
@@ -282,7 +670,7 @@ def process_create_cashout_request(request):
     from accounts.models import Account, CashoutMethod
     from accounts.services import create_new_cashout_method
 
-    content_type = ContentType.objects.get(model="cashoutmethod")
+    content_type = get_content_type("cashoutmethod")
     account = get_object_or_404(Account, account_id=request.data["account_id"])
 
     if account:
@@ -337,7 +725,7 @@ def process_save_cashout_status(request):
 
 def create_payout_activity(request, updated_cashout):
     if updated_cashout:
-        content_type = ContentType.objects.get(model="activity")
+        content_type = get_content_type("activity")
         total_tax = (100 - get_cashout_total_tax()) / 100
 
         return create_activity(
@@ -354,7 +742,7 @@ def create_payout_activity(request, updated_cashout):
 
 def create_company_earning_activity(request, updated_cashout):
     if updated_cashout:
-        content_type = ContentType.objects.get(model="activity")
+        content_type = get_content_type("activity")
         total_tax_earning = get_cashout_total_tax() / 100
 
         return create_activity(
@@ -372,7 +760,7 @@ def create_company_earning_activity(request, updated_cashout):
 # Entry
 def create_entry_activity(request, account=None, new_member_package=None, code=None):
     if new_member_package.is_franchise:
-        content_type = ContentType.objects.get(model="franchisee")
+        content_type = get_content_type("franchisee")
 
         return create_activity(
             account=account.referrer,
@@ -385,7 +773,7 @@ def create_entry_activity(request, account=None, new_member_package=None, code=N
             user=request.user,
         )
 
-    content_type = ContentType.objects.get(model="account")
+    content_type = get_content_type("account")
     if code.code_type == CodeType.FREE_SLOT:
         return create_activity(
             account=account,
@@ -412,7 +800,7 @@ def create_entry_activity(request, account=None, new_member_package=None, code=N
 
 def create_referral_activity(request, sponsor=None, account=None, new_member_package=None, code=None):
     if new_member_package.is_franchise:
-        content_type = ContentType.objects.get(model="franchisee")
+        content_type = get_content_type("franchisee")
         franchise_commission_percentage = get_setting(Settings.FRANCHISE_COMMISSION_PERCENTAGE) / 100
         return create_activity(
             account=sponsor,
@@ -425,7 +813,7 @@ def create_referral_activity(request, sponsor=None, account=None, new_member_pac
             user=request.user,
         )
 
-    content_type = ContentType.objects.get(model="account")
+    content_type = get_content_type("account")
     direct_referral_percentage = get_setting(Settings.DIRECT_REFERRAL_PERCENTAGE) / 100
     if code.code_type == CodeType.FREE_SLOT:
         return create_activity(
@@ -451,13 +839,34 @@ def create_referral_activity(request, sponsor=None, account=None, new_member_pac
     )
 
     if referral:
-        create_referral_bonus_activity(request, sponsor, new_member_package)
+        create_referral_bonus_activity(request, sponsor, new_member_package, account)
 
         return referral
 
 
-def create_referral_bonus_activity(request, sponsor=None, new_member_package=None):
-    referral_count_by_package = sponsor.get_all_direct_referral_by_package_count(new_member_package)
+def get_referral_count_by_package(sponsor=None, package=None, new_member=None, placed_accounts=None):
+    referral_count = sponsor.get_all_direct_referral_by_package_count(package)
+    if not settings.COMP_PLAN_ASYNC:
+        return referral_count
+
+    # Referrals still waiting in the comp plan queue were placed after the new member
+    queued_referrals = (
+        CompPlanJob.objects.filter(
+            status__in=[CompPlanJobStatus.PENDING, CompPlanJobStatus.RUNNING],
+            account__referrer=sponsor,
+            account__package=package,
+        )
+        .exclude(account__activation_code__code_type=CodeType.FREE_SLOT)
+        .exclude(account__in=[new_member, *(placed_accounts or [])])
+        .values("account")
+        .distinct()
+        .count()
+    )
+    return referral_count - queued_referrals
+
+
+def create_referral_bonus_activity(request, sponsor=None, new_member_package=None, new_member=None):
+    referral_count_by_package = get_referral_count_by_package(sponsor, new_member_package, new_member)
     referral_bonus_count = get_setting(Settings.REFERRAL_BONUS_COUNT)
     sponsor_referral_bonus = get_referral_bonus_details(sponsor.package, new_member_package)
     point_value_conversion = get_setting(Settings.POINT_VALUE_CONVERSION)
@@ -474,7 +883,7 @@ def create_referral_bonus_activity(request, sponsor=None, new_member_package=Non
 
 
 def create_downline_entry_activity(request, parent=None, child=None, child_side=None, new_member_package=None):
-    content_type = ContentType.objects.get(model="account")
+    content_type = get_content_type("account")
 
     match child_side:
         case ParentSide.LEFT:
@@ -502,7 +911,7 @@ def create_downline_entry_activity(request, parent=None, child=None, child_side=
 
 
 def create_sales_match_activity(request, parent=None, sales_match_amount_pv=None):
-    content_type = ContentType.objects.get(model="activity")
+    content_type = get_content_type("activity")
     pv_conversion = get_setting(Settings.POINT_VALUE_CONVERSION)
 
     pv_sales_match = create_activity(
@@ -556,10 +965,10 @@ def create_sales_match_activity(request, parent=None, sales_match_amount_pv=None
 
 def create_leadership_bonus_activity(request, sales_match_amount_pv=None, account=None, pv_sales_match_pk=None):
     pv_conversion = get_setting(Settings.POINT_VALUE_CONVERSION)
-    two_level_referrers = account.get_two_level_referrer()
-    content_type = ContentType.objects.get(model="activity")
+    sponsors = account.get_sponsor_upline(get_leadership_bonus_levels())
+    content_type = get_content_type("activity")
 
-    for referrer in two_level_referrers:
+    for referrer in sponsors:
         leadership_bonus = get_leadership_bonus_details(referrer["package"], referrer["level"])
         if leadership_bonus is not None:
             leadership_bonus_pv_percentage = leadership_bonus.point_value_percentage / 100
@@ -579,36 +988,10 @@ def create_leadership_bonus_activity(request, sales_match_amount_pv=None, accoun
 def create_fifth_pairing(request, account=None, pv_sales_match_pk=None):
     fifth_pair_percentage = get_setting(Settings.FIFTH_PAIR_PERCENTAGE) / 100
     pv_conversion = get_setting(Settings.POINT_VALUE_CONVERSION)
-    content_type = ContentType.objects.get(model="activity")
+    content_type = get_content_type("activity")
 
-    total_fifth_pair_amount = (
-        Activity.objects.filter(account=account, wallet=WalletType.GC_WALLET)
-        .values("activity_type")
-        .annotate(
-            activity_total=Case(
-                When(
-                    Q(activity_type=ActivityType.FIFTH_PAIR),
-                    then=Sum(F("activity_amount")),
-                ),
-            )
-        )
-        .aggregate(total=Coalesce(Sum("activity_total"), 0, output_field=DecimalField()))
-        .get("total")
-    )
-
-    pv_total_wallet = (
-        Activity.objects.filter(account=account, wallet=WalletType.PV_TOTAL_WALLET)
-        .values("activity_type")
-        .annotate(
-            activity_total=Sum(F("activity_amount")),
-        )
-        .aggregate(total=Coalesce(Sum("activity_total"), 0, output_field=DecimalField()))
-        .get("total")
-    )
-
-    total_fifth_pair_pv_amount = total_fifth_pair_amount / pv_conversion
-
-    remaining_fifth_pair_pv_amount = pv_total_wallet - (total_fifth_pair_pv_amount / fifth_pair_percentage)
+    fifth_pair_progress = get_object_or_none(FifthPairProgress, account=account) or FifthPairProgress(account=account)
+    remaining_fifth_pair_pv_amount = fifth_pair_progress.get_unpaid_pv(fifth_pair_percentage, pv_conversion)
 
     fifth_pair_pv_match = (
         remaining_fifth_pair_pv_amount - (remaining_fifth_pair_pv_amount % 100)
@@ -675,67 +1058,66 @@ def create_flushout_activity(request, parent=None, child_side=None):
 
 
 def find_total_sales_match_points_today(parent=None):
-    sales_match_points_today = (
-        Activity.objects.annotate(created_local_tz=TruncDate("created", tzinfo=get_localzone()))
-        .filter(
-            account=parent,
-            wallet=WalletType.PV_TOTAL_WALLET,
-            created_local_tz=timezone.localtime().date(),
-            activity_type=ActivityType.PV_SALES_MATCH,
+    return get_sales_match_points_today([parent]).get(parent.pk, decimal.Decimal(0))
+
+
+def get_sales_match_points_today(accounts=None):
+    return dict(
+        DailySalesMatch.objects.filter(account__in=accounts, date=timezone.localtime().date()).values_list(
+            "account", "points"
         )
-        .aggregate(total=Coalesce(Sum("activity_amount"), 0, output_field=DecimalField()))
-        .get("total")
     )
 
-    return sales_match_points_today
 
-
-def get_pv_wallets_info(parent=None, child_side=None):
-    left_wallet_total = (
-        Activity.objects.filter(account=parent, wallet=WalletType.PV_LEFT_WALLET)
-        .values("activity_type")
-        .annotate(
-            activity_total=Case(
-                When(
-                    Q(activity_type=ActivityType.FLUSH_OUT_PENALTY),
-                    then=(Sum(F("activity_amount"))),
-                ),
-                When(
-                    Q(activity_type=ActivityType.PV_SALES_MATCH),
-                    then=(Sum(F("activity_amount"))),
-                ),
-                When(
-                    Q(activity_type=ActivityType.DOWNLINE_ENTRY),
-                    then=Sum(F("activity_amount")),
-                ),
-            ),
+def get_pv_wallet_balances(accounts=None):
+    return {
+        (account_id, wallet): balance
+        for account_id, wallet, balance in PointValueBalance.objects.filter(account__in=accounts).values_list(
+            "account", "wallet", "balance"
         )
-        .aggregate(total=Coalesce(Sum("activity_total"), 0, output_field=DecimalField()))
-        .get("total")
+    }
+
+
+def lock_pv_wallet_balances(accounts=None):
+    account_ids = [account.pk for account in accounts]
+    existing = set(
+        PointValueBalance.objects.filter(account__in=account_ids).values_list("account", "wallet").order_by()
     )
-    right_wallet_total = (
-        Activity.objects.filter(account=parent, wallet=WalletType.PV_RIGHT_WALLET)
-        .values("activity_type")
-        .annotate(
-            activity_total=Case(
-                When(
-                    Q(activity_type=ActivityType.FLUSH_OUT_PENALTY),
-                    then=(Sum(F("activity_amount"))),
-                ),
-                When(
-                    Q(activity_type=ActivityType.PV_SALES_MATCH),
-                    then=(Sum(F("activity_amount"))),
-                ),
-                When(
-                    Q(activity_type=ActivityType.DOWNLINE_ENTRY),
-                    then=Sum(F("activity_amount")),
-                ),
-            ),
-        )
-        .aggregate(total=Coalesce(Sum("activity_total"), 0, output_field=DecimalField()))
-        .get("total")
+    missing = [
+        PointValueBalance(account_id=account_id, wallet=wallet)
+        for account_id in account_ids
+        for wallet in POINT_VALUE_WALLETS
+        if (account_id, wallet) not in existing
+    ]
+    if missing:
+        PointValueBalance.objects.bulk_create(missing, ignore_conflicts=True)
+
+    # Every comp plan locks the balances of its whole upline in one statement, nearest ancestor first, so two signups
+    # sharing ancestors always queue on them in the same order and cannot deadlock on them. The locks are held until
+    # commit, and every signup shares the root, so comp plans still run one at a time. The wallet balance and
+    # leaderboard rows updated for the sponsors are not covered by this ordering and rely on the deadlock retry
+    return list(
+        PointValueBalance.objects.select_for_update(of=("self",))
+        .filter(account__in=account_ids)
+        .order_by("-account__placement_level", "account", "wallet")
+        .values_list("id", flat=True)
     )
 
+
+def is_serialization_failure(error=None):
+    # 40001 serialization_failure, 40P01 deadlock_detected
+    return getattr(error.__cause__, "pgcode", None) in ("40001", "40P01")
+
+
+def get_pv_wallets_info(parent=None, child_side=None):
+    pv_wallet_balances = get_pv_wallet_balances([parent])
+    left_wallet_total = pv_wallet_balances.get((parent.pk, WalletType.PV_LEFT_WALLET), decimal.Decimal(0))
+    right_wallet_total = pv_wallet_balances.get((parent.pk, WalletType.PV_RIGHT_WALLET), decimal.Decimal(0))
+
+    return compare_pv_wallets(left_wallet_total, right_wallet_total, child_side)
+
+
+def compare_pv_wallets(left_wallet_total=None, right_wallet_total=None, child_side=None):
     if left_wallet_total > right_wallet_total:
         return left_wallet_total, right_wallet_total, WalletType.PV_LEFT_WALLET
     elif right_wallet_total > left_wallet_total:
@@ -749,6 +1131,25 @@ def get_pv_wallets_info(parent=None, child_side=None):
 
 
 def comp_plan(request, new_member, new_member_package, code):
+    # A failed attempt inside an outer transaction would also roll back the caller's work, so only the outermost
+    # call retries
+    attempts = 1 if connection.in_atomic_block else settings.COMP_PLAN_LOCK_ATTEMPTS
+    for attempt in range(1, attempts + 1):
+        try:
+            with transaction.atomic():
+                if settings.COMP_PLAN_BATCHED:
+                    return batched_comp_plan(request, new_member, new_member_package, code)
+
+                return run_comp_plan(request, new_member, new_member_package, code)
+        except OperationalError as e:
+            if attempt == attempts or not is_serialization_failure(e):
+                raise
+
+            logger.warning("Retrying comp plan of account %s after lock conflict: %s" % (new_member.pk, e))
+            time.sleep(random.uniform(0, settings.COMP_PLAN_LOCK_RETRY_DELAY * attempt))
+
+
+def run_comp_plan(request, new_member, new_member_package, code):
     entry_activity = create_entry_activity(request, new_member, new_member_package, code)
     if new_member.referrer and entry_activity:
         referral_activity = create_referral_activity(request, new_member.referrer, new_member, new_member_package, code)
@@ -767,6 +1168,7 @@ def comp_plan(request, new_member, new_member_package, code):
         current_parent = parent["account"]
         current_level = parent["level"]
         current_parent_package = get_package_details(parent["package"])
+        lock_pv_wallet_balances([current_parent])
 
         # Possible that if account is already on flushout, will no longer create downline_entry_activity
         # Will still create flushout activity?
@@ -858,3 +1260,735 @@ def comp_plan(request, new_member, new_member_package, code):
                     create_flushout_activity(request, current_parent, parent["side"])
     else:
         return True
+
+
+# Batched Comp Plan
+class CompPlanBatch:
+    """
+    Runs the comp plan of one or more new members, in order, against upline state loaded in a few
+    set-based queries. Activities are computed in memory, mirroring the per-row create_* functions, and
+    persisted together by save(), so an ancestor shared by several new members is written once.
+    """
+
+    def __init__(self):
+        self.user = None
+        self.settings = get_settings_snapshot()
+        self.rules = get_comp_plan_rules()
+        self.account_content_type = self.rules.content_types["account"]
+        self.activity_content_type = self.rules.content_types["activity"]
+        self.franchisee_content_type = self.rules.content_types["franchisee"]
+        self.activities = []
+        self.pv_wallet_totals = defaultdict(decimal.Decimal)
+        self.sales_match_points_today = defaultdict(decimal.Decimal)
+        self.fifth_pair_progress = {}
+        self.sponsors = {}
+        self.loaded_accounts = set()
+        self.placed_accounts = []
+
+    def get_setting(self, property):
+        return self.settings.get(property)
+
+    def load_upline_state(self, accounts):
+        from accounts.models import Account
+
+        # Accounts already loaded by an earlier new member of this batch carry unsaved changes
+        account_ids = [account.pk for account in accounts if account.pk not in self.loaded_accounts]
+        if not account_ids:
+            return
+        self.loaded_accounts.update(account_ids)
+
+        for (account_id, wallet), balance in get_pv_wallet_balances(account_ids).items():
+            if wallet != WalletType.PV_TOTAL_WALLET:
+                self.pv_wallet_totals[(account_id, wallet)] = balance
+
+        self.sales_match_points_today.update(get_sales_match_points_today(account_ids))
+
+        for fifth_pair_progress in FifthPairProgress.objects.filter(account__in=account_ids):
+            self.fifth_pair_progress[fifth_pair_progress.account_id] = fifth_pair_progress
+
+        sponsor_ids = {
+            pk
+            for account in accounts
+            for pk in account.get_sponsor_hops(self.rules.leadership_levels)
+            if pk not in self.sponsors
+        }
+        self.sponsors.update(Account.objects.select_related("package").in_bulk(sponsor_ids))
+
+    def create_activity(
+        self,
+        account=None,
+        activity_type=None,
+        activity_amount=None,
+        status=None,
+        wallet=None,
+        content_type=None,
+        object_id=None,
+        source=None,
+    ):
+        amount = quantize_activity_amount(activity_amount)
+        activity = Activity(
+            account_id=account.pk if account else None,
+            activity_type=activity_type,
+            activity_amount=amount,
+            status=status,
+            wallet=wallet,
+            content_type=content_type,
+            object_id=object_id,
+            created_by=self.user,
+        )
+        # Activities pointing at an activity of this batch get its pk once it is saved
+        activity.source = source
+        self.activities.append(activity)
+
+        match wallet:
+            case WalletType.PV_LEFT_WALLET | WalletType.PV_RIGHT_WALLET:
+                self.pv_wallet_totals[(account.pk, wallet)] += amount
+            case WalletType.PV_TOTAL_WALLET:
+                self.get_fifth_pair_progress(account).matched_pv += amount
+                if activity_type == ActivityType.PV_SALES_MATCH:
+                    self.sales_match_points_today[account.pk] += amount
+            case WalletType.GC_WALLET:
+                if activity_type == ActivityType.FIFTH_PAIR:
+                    self.get_fifth_pair_progress(account).paid_amount += amount
+
+        return activity
+
+    def save(self):
+        with transaction.atomic():
+            Activity.objects.bulk_create([activity for activity in self.activities if activity.source is None])
+
+            dependent_activities = [activity for activity in self.activities if activity.source is not None]
+            for activity in dependent_activities:
+                activity.object_id = activity.source.pk
+            Activity.objects.bulk_create(dependent_activities)
+
+            update_point_value_balances(self.activities)
+            update_daily_sales_matches(self.activities)
+            update_fifth_pair_progress(self.activities)
+            update_wallet_balances(self.activities)
+            update_leaderboard(self.activities)
+
+        return self.activities
+
+    def get_fifth_pair_progress(self, account=None):
+        if account.pk not in self.fifth_pair_progress:
+            self.fifth_pair_progress[account.pk] = FifthPairProgress(account_id=account.pk)
+        return self.fifth_pair_progress[account.pk]
+
+    def get_upline(self, new_member=None):
+        parents = new_member.get_all_parents_with_side()
+        upline = [parent["account"] for parent in parents]
+        lock_pv_wallet_balances([account for account in upline if account.pk not in self.loaded_accounts])
+        self.load_upline_state(upline)
+        return parents
+
+    def get_referral_count(self, sponsor=None, package=None, new_member=None):
+        return get_referral_count_by_package(sponsor, package, new_member, self.placed_accounts)
+
+    def get_pv_wallets_info(self, parent=None, child_side=None):
+        return compare_pv_wallets(
+            self.pv_wallet_totals[(parent.pk, WalletType.PV_LEFT_WALLET)],
+            self.pv_wallet_totals[(parent.pk, WalletType.PV_RIGHT_WALLET)],
+            child_side,
+        )
+
+    def get_sponsor_upline(self, account=None):
+        sponsors = []
+        for level, pk in enumerate(account.get_sponsor_hops(self.rules.leadership_levels), start=1):
+            if pk in self.sponsors:
+                sponsors.append({"account": self.sponsors[pk], "level": level, "package": self.sponsors[pk].package})
+        return sponsors
+
+    def create_entry_activity(self, account=None, new_member_package=None, code=None):
+        if new_member_package.is_franchise:
+            return self.create_activity(
+                account=account.referrer,
+                activity_type=ActivityType.FRANCHISE_ENTRY,
+                activity_amount=new_member_package.package_amount,
+                status=ActivityStatus.DONE,
+                wallet=WalletType.C_WALLET,
+                content_type=self.franchisee_content_type,
+                object_id=account.pk,
+            )
+
+        return self.create_activity(
+            account=account,
+            activity_type=ActivityType.ENTRY,
+            activity_amount=0 if code.code_type == CodeType.FREE_SLOT else new_member_package.package_amount,
+            status=ActivityStatus.DONE,
+            wallet=WalletType.C_WALLET,
+            content_type=self.account_content_type,
+            object_id=account.pk,
+        )
+
+    def create_referral_activity(self, sponsor=None, account=None, new_member_package=None, code=None):
+        if new_member_package.is_franchise:
+            franchise_commission_percentage = self.get_setting(Settings.FRANCHISE_COMMISSION_PERCENTAGE) / 100
+            return self.create_activity(
+                account=sponsor,
+                activity_type=ActivityType.FRANCHISE_COMMISSION,
+                activity_amount=new_member_package.package_amount * franchise_commission_percentage,
+                status=ActivityStatus.DONE,
+                wallet=WalletType.F_WALLET,
+                content_type=self.franchisee_content_type,
+                object_id=account.pk,
+            )
+
+        if code.code_type == CodeType.FREE_SLOT:
+            return self.create_activity(
+                account=sponsor,
+                activity_type=ActivityType.DIRECT_REFERRAL,
+                activity_amount=0,
+                status=ActivityStatus.DONE,
+                wallet=WalletType.B_WALLET,
+                content_type=self.account_content_type,
+                object_id=account.pk,
+            )
+
+        direct_referral_percentage = self.get_setting(Settings.DIRECT_REFERRAL_PERCENTAGE) / 100
+        referral = self.create_activity(
+            account=sponsor,
+            activity_type=ActivityType.DIRECT_REFERRAL,
+            activity_amount=new_member_package.package_amount * direct_referral_percentage,
+            status=ActivityStatus.DONE,
+            wallet=WalletType.B_WALLET,
+            content_type=self.account_content_type,
+            object_id=account.pk,
+        )
+        self.create_referral_bonus_activity(sponsor, new_member_package, account)
+
+        return referral
+
+    def create_referral_bonus_activity(self, sponsor=None, new_member_package=None, new_member=None):
+        referral_count_by_package = self.get_referral_count(sponsor, new_member_package, new_member)
+        referral_bonus_count = self.get_setting(Settings.REFERRAL_BONUS_COUNT)
+        sponsor_referral_bonus = self.rules.get_referral_bonus(sponsor.package, new_member_package)
+        point_value_conversion = self.get_setting(Settings.POINT_VALUE_CONVERSION)
+
+        if referral_count_by_package % referral_bonus_count == 0 and sponsor_referral_bonus:
+            return self.create_activity(
+                account=sponsor,
+                activity_type=ActivityType.REFERRAL_BONUS,
+                activity_amount=sponsor_referral_bonus.point_value * point_value_conversion,
+                status=ActivityStatus.DONE,
+                wallet=WalletType.B_WALLET,
+            )
+
+    def create_downline_entry_activity(self, parent=None, child=None, child_side=None, new_member_package=None):
+        match child_side:
+            case ParentSide.LEFT:
+                wallet = WalletType.PV_LEFT_WALLET
+            case ParentSide.RIGHT:
+                wallet = WalletType.PV_RIGHT_WALLET
+            case _:
+                return None
+
+        return self.create_activity(
+            account=parent,
+            activity_type=ActivityType.DOWNLINE_ENTRY,
+            activity_amount=new_member_package.point_value,
+            status=ActivityStatus.DONE,
+            wallet=wallet,
+            content_type=self.account_content_type,
+            object_id=child.pk,
+        )
+
+    def create_sales_match_activity(self, parent=None, sales_match_amount_pv=None):
+        pv_conversion = self.get_setting(Settings.POINT_VALUE_CONVERSION)
+
+        pv_sales_match = self.create_activity(
+            account=parent,
+            activity_type=ActivityType.PV_SALES_MATCH,
+            activity_amount=sales_match_amount_pv,
+            status=ActivityStatus.DONE,
+            wallet=WalletType.PV_TOTAL_WALLET,
+        )
+        for wallet in [WalletType.PV_LEFT_WALLET, WalletType.PV_RIGHT_WALLET]:
+            self.create_activity(
+                account=parent,
+                activity_type=ActivityType.PV_SALES_MATCH,
+                activity_amount=-abs(sales_match_amount_pv),
+                status=ActivityStatus.DONE,
+                wallet=wallet,
+                content_type=self.activity_content_type,
+                source=pv_sales_match,
+            )
+
+        fifth_pair_amount = self.create_fifth_pairing(parent, pv_sales_match)
+
+        if ((sales_match_amount_pv * pv_conversion) - fifth_pair_amount) > 0:
+            self.create_activity(
+                account=parent,
+                activity_type=ActivityType.SALES_MATCH,
+                activity_amount=(sales_match_amount_pv * pv_conversion) - fifth_pair_amount,
+                status=ActivityStatus.DONE,
+                wallet=WalletType.B_WALLET,
+                content_type=self.activity_content_type,
+                source=pv_sales_match,
+            )
+            self.create_leadership_bonus_activity(sales_match_amount_pv, parent, pv_sales_match)
+
+    def create_leadership_bonus_activity(self, sales_match_amount_pv=None, account=None, pv_sales_match=None):
+        pv_conversion = self.get_setting(Settings.POINT_VALUE_CONVERSION)
+
+        for referrer in self.get_sponsor_upline(account):
+            leadership_bonus = self.rules.get_leadership_bonus(referrer["package"], referrer["level"])
+            if leadership_bonus is not None:
+                leadership_bonus_pv_percentage = leadership_bonus.point_value_percentage / 100
+
+                self.create_activity(
+                    account=referrer["account"],
+                    activity_type=ActivityType.LEADERSHIP_BONUS,
+                    activity_amount=(sales_match_amount_pv * leadership_bonus_pv_percentage) * pv_conversion,
+                    status=ActivityStatus.DONE,
+                    wallet=WalletType.B_WALLET,
+                    content_type=self.activity_content_type,
+                    source=pv_sales_match,
+                )
+
+    def create_fifth_pairing(self, account=None, pv_sales_match=None):
+        fifth_pair_percentage = self.get_setting(Settings.FIFTH_PAIR_PERCENTAGE) / 100
+        pv_conversion = self.get_setting(Settings.POINT_VALUE_CONVERSION)
+
+        remaining_fifth_pair_pv_amount = self.get_fifth_pair_progress(account).get_unpaid_pv(
+            fifth_pair_percentage, pv_conversion
+        )
+        fifth_pair_pv_match = (
+            remaining_fifth_pair_pv_amount - (remaining_fifth_pair_pv_amount % 100)
+        ) * fifth_pair_percentage
+
+        if fifth_pair_pv_match:
+            fifth_pair = self.create_activity(
+                account=account,
+                activity_type=ActivityType.FIFTH_PAIR,
+                activity_amount=fifth_pair_pv_match * pv_conversion,
+                status=ActivityStatus.DONE,
+                wallet=WalletType.GC_WALLET,
+                content_type=self.activity_content_type,
+                source=pv_sales_match,
+            )
+
+            return fifth_pair.activity_amount
+
+        return 0
+
+    def create_flushout_activity(self, parent=None, child_side=None):
+        penalty_weak = self.get_setting(Settings.FLUSH_OUT_PENALTY_PERCENTAGE_WEAK) / 100
+        penalty_strong = self.get_setting(Settings.FLUSH_OUT_PENALTY_PERCENTAGE_STRONG) / 100
+
+        strong_side_wallet_total, weak_side_wallet_total, strong_side_wallet = self.get_pv_wallets_info(
+            parent, child_side
+        )
+        strong_side_penalty = -abs(strong_side_wallet_total * penalty_strong)
+        weak_side_penalty = -abs(weak_side_wallet_total * penalty_weak)
+
+        match strong_side_wallet:
+            case WalletType.PV_LEFT_WALLET:
+                penalties = [
+                    (WalletType.PV_LEFT_WALLET, strong_side_penalty),
+                    (WalletType.PV_RIGHT_WALLET, weak_side_penalty),
+                ]
+            case WalletType.PV_RIGHT_WALLET:
+                penalties = [
+                    (WalletType.PV_LEFT_WALLET, weak_side_penalty),
+                    (WalletType.PV_RIGHT_WALLET, strong_side_penalty),
+                ]
+
+        for wallet, penalty in penalties:
+            self.create_activity(
+                account=parent,
+                activity_type=ActivityType.FLUSH_OUT_PENALTY,
+                activity_amount=penalty,
+                status=ActivityStatus.DONE,
+                wallet=wallet,
+            )
+
+    def run(self, request, new_member, new_member_package, code):
+        self.user = request.user if request.user.is_authenticated else None
+        is_valid = self.run_comp_plan(new_member, new_member_package, code)
+        self.placed_accounts.append(new_member)
+
+        return is_valid
+
+    def run_comp_plan(self, new_member, new_member_package, code):
+        referral_activity = None
+        entry_activity = self.create_entry_activity(new_member, new_member_package, code)
+        if new_member.referrer and entry_activity:
+            referral_activity = self.create_referral_activity(new_member.referrer, new_member, new_member_package, code)
+
+            if referral_activity is None:
+                return False
+
+        if new_member_package.is_franchise:
+            return True
+
+        if code.code_type == CodeType.FREE_SLOT and referral_activity:
+            return True
+
+        parents = self.get_upline(new_member)
+        for parent in parents:
+            current_parent = parent["account"]
+            current_parent_package = parent["package"]
+
+            downline_entry_activity = self.create_downline_entry_activity(
+                current_parent, new_member, parent["side"], new_member_package
+            )
+
+            if downline_entry_activity is None:
+                continue
+
+            strong_side_wallet_total, weak_side_wallet_total, strong_side_wallet = self.get_pv_wallets_info(
+                current_parent, parent["side"]
+            )
+            if strong_side_wallet_total > 0 and weak_side_wallet_total > 0:
+                if strong_side_wallet_total > weak_side_wallet_total:
+                    sales_match_amount_pv = weak_side_wallet_total
+                else:
+                    sales_match_amount_pv = new_member_package.point_value
+
+                total_sales_match_points_today = self.sales_match_points_today[current_parent.pk]
+                remaining_sales_match_points_today = (
+                    current_parent_package.flush_out_limit - total_sales_match_points_today
+                )
+                if remaining_sales_match_points_today - sales_match_amount_pv >= 0:
+                    self.create_sales_match_activity(current_parent, sales_match_amount_pv)
+                else:
+                    if remaining_sales_match_points_today > 0:
+                        self.create_sales_match_activity(current_parent, remaining_sales_match_points_today)
+                    self.create_flushout_activity(current_parent, parent["side"])
+
+        return True
+
+
+def batched_comp_plan(request, new_member, new_member_package, code):
+    comp_plan_batch = CompPlanBatch()
+    is_valid = comp_plan_batch.run(request, new_member, new_member_package, code)
+    comp_plan_batch.save()
+
+    return is_valid
+
+
+# Comp Plan Replay
+class ReplayAccount:
+    __slots__ = ("pk", "package", "referrer")
+
+    def __init__(self, pk=None, package=None, referrer=None):
+        self.pk = pk
+        self.package = package
+        self.referrer = referrer
+
+
+class CompPlanReplay(CompPlanBatch):
+    """
+    Re-runs the comp plan of every registration, upgrade and franchisee in the order the ledger recorded
+    them, with the current settings and rules, against the tree held in flat arrays instead of the database.
+    Activities are numbered and handed to write_activity after each event instead of being saved.
+    """
+
+    def __init__(self, write_activity=None):
+        super().__init__()
+        self.write_activity = write_activity
+        self.next_activity_id = 1
+        self.positions = {}
+        self.account_ids = array("q")
+        self.parents = array("q")
+        self.sides = []
+        self.referrers = array("q")
+        self.packages = array("q")
+        self.counted_referrals = bytearray()
+        self.referral_counts = defaultdict(int)
+        self.codes = {code_type: Code(code_type=code_type) for code_type in CodeType}
+        self.events = []
+        self.date = None
+
+    def load(self):
+        from accounts.models import Account
+        from core.models import Franchisee
+
+        accounts = list(
+            Account.objects.order_by("created", "id").values_list(
+                "id", "parent_id", "parent_side", "referrer_id", "package_id"
+            )
+        )
+        for position, (account_id, parent_id, parent_side, referrer_id, package_id) in enumerate(accounts):
+            self.positions[account_id] = position
+        for account in accounts:
+            self.add_account(*account)
+
+        # The ENTRY activities are the only record of upgrades. Earlier packages are matched by amount, so a
+        # free slot (entry of 0) that was upgraded later replays with its current package
+        package_amounts = {
+            package.package_amount: package.pk for package in self.rules.packages.values() if not package.is_franchise
+        }
+        entries = defaultdict(list)
+        for activity_id, account_id, amount, created in (
+            Activity.objects.filter(activity_type=ActivityType.ENTRY, content_type=self.account_content_type)
+            .order_by("created", "id")
+            .values_list("id", "object_id", "activity_amount", "created")
+            .iterator()
+        ):
+            if account_id in self.positions:
+                entries[account_id].append((activity_id, amount, created))
+
+        for account_id, account_entries in entries.items():
+            position = self.positions[account_id]
+            current_package_id = self.packages[position]
+            for index, (activity_id, amount, created) in enumerate(account_entries):
+                if index == len(account_entries) - 1:
+                    package_id = current_package_id
+                else:
+                    package_id = package_amounts.get(amount, current_package_id)
+                if index == 0:
+                    code_type = CodeType.FREE_SLOT if amount == 0 else CodeType.ACTIVATION
+                else:
+                    code_type = CodeType.UPGRADE
+                self.events.append((created, 0, activity_id, position, package_id, code_type))
+
+        for franchisee_id, referrer_id, package_id, created in Franchisee.objects.values_list(
+            "id", "referrer_id", "package_id", "created"
+        ):
+            self.events.append((created, 1, franchisee_id, self.positions.get(referrer_id, -1), package_id, None))
+
+        self.events.sort()
+
+    def add_account(self, account_id=None, parent_id=None, parent_side=None, referrer_id=None, package_id=None):
+        self.positions[account_id] = len(self.account_ids)
+        self.account_ids.append(account_id)
+        self.parents.append(self.positions.get(parent_id, -1))
+        self.sides.append(parent_side)
+        self.referrers.append(self.positions.get(referrer_id, -1))
+        self.packages.append(package_id or 0)
+        self.counted_referrals.append(0)
+        return self.positions[account_id]
+
+    def get_account(self, position=None):
+        return ReplayAccount(self.account_ids[position], self.rules.packages.get(self.packages[position]))
+
+    def get_upline(self, new_member=None):
+        parents = []
+        position = self.positions[new_member.pk]
+        level = 0
+        while self.parents[position] >= 0:
+            level += 1
+            side = self.sides[position]
+            position = self.parents[position]
+            parent = self.get_account(position)
+            parents.append({"account": parent, "side": side, "level": level, "package": parent.package})
+        return parents
+
+    def get_sponsor_upline(self, account=None):
+        sponsors = []
+        position = self.referrers[self.positions[account.pk]]
+        for level in range(1, self.rules.leadership_levels + 1):
+            if position < 0:
+                break
+            sponsor = self.get_account(position)
+            sponsors.append({"account": sponsor, "level": level, "package": sponsor.package})
+            position = self.referrers[position]
+        return sponsors
+
+    def get_referral_count(self, sponsor=None, package=None, new_member=None):
+        return self.referral_counts[(sponsor.pk, package.pk)]
+
+    def count_referral(self, position=None, package_id=None, code_type=None):
+        sponsor_position = self.referrers[position]
+        if sponsor_position < 0:
+            return
+
+        sponsor_id = self.account_ids[sponsor_position]
+        if self.counted_referrals[position]:
+            self.referral_counts[(sponsor_id, self.packages[position])] -= 1
+        if code_type != CodeType.FREE_SLOT:
+            self.referral_counts[(sponsor_id, package_id)] += 1
+            self.counted_referrals[position] = 1
+
+    def replay(self):
+        self.load()
+        return self.run_events()
+
+    def run_events(self):
+        self.events.sort()
+        for created, event_type, object_id, position, package_id, code_type in self.events:
+            package = self.rules.packages[package_id]
+            if event_type == 0:
+                self.count_referral(position, package_id, code_type)
+                self.packages[position] = package_id
+                new_member = self.get_account(position)
+                if self.referrers[position] >= 0:
+                    new_member.referrer = self.get_account(self.referrers[position])
+                self.run_event(created, new_member, package, self.codes[code_type])
+            else:
+                referrer = self.get_account(position) if position >= 0 else None
+                new_franchisee = ReplayAccount(object_id, package, referrer)
+                self.run_event(created, new_franchisee, package, self.codes[CodeType.ACTIVATION])
+
+        return len(self.events)
+
+    def run_event(self, created=None, new_member=None, new_member_package=None, code=None):
+        date = timezone.localtime(created, get_localzone()).date()
+        if date != self.date:
+            self.date = date
+            self.sales_match_points_today.clear()
+
+        self.run_comp_plan(new_member, new_member_package, code)
+        for activity in self.activities:
+            activity.pk = self.next_activity_id
+            self.next_activity_id += 1
+            if activity.source is not None:
+                activity.object_id = activity.source.pk
+            activity.created = activity.modified = created
+            self.write_activity(activity)
+        self.activities = []
+
+
+# Comp Plan Jobs
+class CompPlanJobRequest:
+    """
+    Stands in for the registration request when a queued comp plan runs in a worker.
+    """
+
+    def __init__(self, user=None):
+        self.user = user if user is not None else AnonymousUser()
+        self.data = {}
+
+
+def enqueue_comp_plan_job(request, account=None, package=None, code=None, job_type=None):
+    ancestry_hops = account.get_ancestry_hops()
+    tree_root_id = ancestry_hops[-1][0] if ancestry_hops else account.pk
+
+    return CompPlanJob.objects.create(
+        job_type=job_type,
+        account=account,
+        tree_root_id=tree_root_id,
+        package=package,
+        code=code,
+        created_by=request.user if request.user.is_authenticated else None,
+    )
+
+
+def claim_comp_plan_jobs(coalesce_window=None):
+    now = timezone.now()
+    stale = now - datetime.timedelta(seconds=settings.COMP_PLAN_JOB_TIMEOUT)
+    if coalesce_window is None:
+        coalesce_window = settings.COMP_PLAN_JOB_COALESCE_WINDOW
+    open_jobs = CompPlanJob.objects.filter(
+        status__in=[CompPlanJobStatus.PENDING, CompPlanJobStatus.RUNNING]
+    ).values_list("id", "tree_root", "status", "available", "started", "created")
+
+    tree_jobs = defaultdict(list)
+    for job in open_jobs:
+        tree_jobs[job[1]].append(job)
+
+    # Only the oldest open jobs of each tree may run, so every ancestor sees its downlines in placement order
+    for jobs in tree_jobs.values():
+        pk, tree_root_id, job_status, available, started, created = jobs[0]
+        is_available = job_status == CompPlanJobStatus.PENDING and available <= now
+        is_stale = job_status == CompPlanJobStatus.RUNNING and started is not None and started < stale
+        if not (is_available or is_stale):
+            continue
+
+        # Registrations arriving in a burst are gathered for a short window and applied as one batch
+        batch = [pk]
+        for next_pk, _, next_status, next_available, _, _ in jobs[1 : settings.COMP_PLAN_JOB_BATCH_SIZE]:
+            if next_status != CompPlanJobStatus.PENDING or next_available > now:
+                break
+            batch.append(next_pk)
+        if len(batch) < settings.COMP_PLAN_JOB_BATCH_SIZE and created > now - datetime.timedelta(
+            seconds=coalesce_window
+        ):
+            continue
+
+        claimed = CompPlanJob.objects.filter(pk=pk, status=job_status, started=started).update(
+            status=CompPlanJobStatus.RUNNING,
+            started=now,
+            attempts=F("attempts") + 1,
+        )
+        if claimed:
+            CompPlanJob.objects.filter(pk__in=batch[1:], status=CompPlanJobStatus.PENDING).update(
+                status=CompPlanJobStatus.RUNNING,
+                started=now,
+                attempts=F("attempts") + 1,
+            )
+            return list(
+                CompPlanJob.objects.select_related("account", "package", "code", "created_by").filter(
+                    pk__in=batch, status=CompPlanJobStatus.RUNNING, started=now
+                )
+            )
+
+    return []
+
+
+def finish_comp_plan_job(job=None, is_valid=None):
+    from accounts.services import activate_account
+
+    if is_valid:
+        if job.job_type == CompPlanJobType.CREATE:
+            activate_account(job.account)
+        job.status = CompPlanJobStatus.DONE
+        job.last_error = None
+        job.finished = timezone.now()
+        job.save()
+    else:
+        fail_comp_plan_job(job, "Unable to process Account activities.")
+
+
+def fail_comp_plan_job(job=None, last_error=None):
+    # The code was used up when the job was queued, a failed job gives it back as a failed inline comp plan leaves it
+    if job.code is not None and job.code.status == CodeStatus.USED:
+        job.code.status = CodeStatus.ACTIVE
+        job.code.save()
+    job.status = CompPlanJobStatus.FAILED
+    job.last_error = last_error
+    job.finished = timezone.now()
+    job.save()
+
+
+def run_comp_plan_job(job=None):
+    try:
+        with transaction.atomic():
+            is_valid = comp_plan(CompPlanJobRequest(job.created_by), job.account, job.package, job.code)
+            finish_comp_plan_job(job, is_valid)
+    except Exception:
+        # The exception may carry database details, it is only kept in the log
+        logger.exception("Comp plan job %s failed." % job.job_id)
+        if job.attempts >= settings.COMP_PLAN_JOB_MAX_ATTEMPTS:
+            fail_comp_plan_job(job, "Unable to process comp plan.")
+        else:
+            job.status = CompPlanJobStatus.PENDING
+            job.last_error = "Unable to process comp plan."
+            job.available = timezone.now() + datetime.timedelta(
+                seconds=settings.COMP_PLAN_JOB_RETRY_DELAY * job.attempts
+            )
+            job.save()
+
+    return job
+
+
+def run_comp_plan_jobs(jobs=None):
+    if len(jobs) > 1:
+        try:
+            with transaction.atomic():
+                comp_plan_batch = CompPlanBatch()
+                results = [
+                    comp_plan_batch.run(CompPlanJobRequest(job.created_by), job.account, job.package, job.code)
+                    for job in jobs
+                ]
+                comp_plan_batch.save()
+                for job, is_valid in zip(jobs, results):
+                    finish_comp_plan_job(job, is_valid)
+            return jobs
+        except Exception:
+            logger.exception("Comp plan batch of %s jobs failed, running them one at a time." % len(jobs))
+
+    for index, job in enumerate(jobs):
+        run_comp_plan_job(job)
+        if job.status == CompPlanJobStatus.PENDING:
+            # The rest of the batch waits behind the job being retried
+            CompPlanJob.objects.filter(pk__in=[job.pk for job in jobs[index + 1 :]]).update(
+                status=CompPlanJobStatus.PENDING,
+                started=None,
+                attempts=F("attempts") - 1,
+            )
+            return jobs[: index + 1]
+
+    return jobs
@@ -0,0 +1,282 @@
+from collections import defaultdict
+import numpy as np
+from django.utils import timezone
+from tzlocal import get_localzone
+from accounts.enums import ParentSide
+from core.enums import ActivityType, CodeType, Settings
+from core.services import CompPlanReplay
+
+SIMULATED_SETTINGS = [
+    Settings.POINT_VALUE_CONVERSION,
+    Settings.DIRECT_REFERRAL_PERCENTAGE,
+    Settings.REFERRAL_BONUS_COUNT,
+    Settings.FRANCHISE_COMMISSION_PERCENTAGE,
+    Settings.FLUSH_OUT_PENALTY_PERCENTAGE_WEAK,
+    Settings.FLUSH_OUT_PENALTY_PERCENTAGE_STRONG,
+    Settings.FIFTH_PAIR_PERCENTAGE,
+]
+PAYOUT_TYPES = [
+    ActivityType.DIRECT_REFERRAL,
+    ActivityType.REFERRAL_BONUS,
+    ActivityType.SALES_MATCH,
+    ActivityType.LEADERSHIP_BONUS,
+    ActivityType.FIFTH_PAIR,
+    ActivityType.FRANCHISE_COMMISSION,
+]
+
+
+class TreeSnapshot:
+    """
+    The accounts, packages and comp plan rules, and every registration, upgrade and franchisee in the order the
+    ledger recorded them, as NumPy arrays that payout simulations can be run against repeatedly.
+    """
+
+    def __init__(self):
+        replay = CompPlanReplay()
+        replay.load()
+        self.settings = replay.settings
+        rules = replay.rules
+
+        self.account_ids = np.array(replay.account_ids, dtype=np.int64)
+        self.parents = np.array(replay.parents, dtype=np.int64)
+        self.referrers = np.array(replay.referrers, dtype=np.int64)
+        self.left_sides = np.array([side == ParentSide.LEFT for side in replay.sides], dtype=bool)
+        self.known_sides = np.array([side in (ParentSide.LEFT, ParentSide.RIGHT) for side in replay.sides], dtype=bool)
+
+        # Package arrays carry a trailing zero row, so accounts without a package (-1) read zeros
+        self.package_ids = sorted(rules.packages)
+        self.package_positions = {package_id: position for position, package_id in enumerate(self.package_ids)}
+        packages = [rules.packages[package_id] for package_id in self.package_ids]
+        self.package_amounts = np.array([float(package.package_amount) for package in packages] + [0.0])
+        self.point_values = np.array([float(package.point_value) for package in packages] + [0.0])
+        self.flush_out_limits = np.array([float(package.flush_out_limit) for package in packages] + [0.0])
+
+        self.referral_bonuses = np.zeros((len(packages) + 1, len(packages) + 1))
+        self.has_referral_bonus = np.zeros((len(packages) + 1, len(packages) + 1), dtype=bool)
+        for (referrer_package_id, referred_package_id), referral_bonus in rules.referral_bonuses.items():
+            position = self.package_positions[referrer_package_id], self.package_positions[referred_package_id]
+            self.referral_bonuses[position] = float(referral_bonus.point_value)
+            self.has_referral_bonus[position] = True
+
+        # Accounts that never went through the comp plan, like the root, keep their current package
+        self.packages = np.array([self.package_positions.get(package_id, -1) for package_id in replay.packages])
+
+        self.leadership_levels = rules.leadership_levels
+        self.leadership_percentages = np.zeros((len(packages) + 1, self.leadership_levels + 1))
+        for (package_id, level), leadership_bonus in rules.leadership_bonuses.items():
+            self.leadership_percentages[self.package_positions[package_id], int(level)] = float(
+                leadership_bonus.point_value_percentage
+            )
+
+        self.events = [
+            (
+                timezone.localtime(created, get_localzone()).date(),
+                event_type,
+                position,
+                self.package_positions[package_id],
+                code_type,
+            )
+            for created, event_type, object_id, position, package_id, code_type in replay.events
+        ]
+
+    def get_upline(self, position=None):
+        ancestors = []
+        left_sides = []
+        while self.parents[position] >= 0:
+            if self.known_sides[position]:
+                left_sides.append(self.left_sides[position])
+                ancestors.append(self.parents[position])
+            position = self.parents[position]
+        return np.array(ancestors, dtype=np.int64), np.array(left_sides, dtype=bool)
+
+    def get_sponsors(self, positions=None):
+        return np.where(positions >= 0, self.referrers[np.maximum(positions, 0)], -1)
+
+
+class PayoutSimulation:
+    def __init__(self, snapshot=None):
+        self.snapshot = snapshot
+        self.payouts = {payout_type: np.zeros(len(snapshot.account_ids)) for payout_type in PAYOUT_TYPES}
+        self.flush_outs = np.zeros(len(snapshot.account_ids))
+
+    def get_totals(self):
+        return {payout_type: round(float(payouts.sum()), 2) for payout_type, payouts in self.payouts.items()}
+
+    def get_account_payouts(self):
+        return sum(self.payouts.values())
+
+
+def get_strong_sides(left_wallets=None, right_wallets=None, left_sides=None):
+    # Mirrors compare_pv_wallets: a tie makes the side opposite the new member's the strong one
+    return (left_wallets > right_wallets) | ((left_wallets == right_wallets) & ~left_sides)
+
+
+def simulate_payouts(snapshot=None, settings=None, flush_out_limits=None, start=None, end=None):
+    """
+    Runs the comp plan of every registration in the snapshot with the candidate settings and package flush out
+    limits applied over the current ones, updating the whole upline of each one at once. Payouts of
+    registrations dated from start up to, but excluding, end are collected.
+    """
+    values = {property: float(snapshot.settings.get(property)) for property in SIMULATED_SETTINGS}
+    values.update({property: float(value) for property, value in (settings or {}).items()})
+    pv_conversion = values[Settings.POINT_VALUE_CONVERSION]
+    direct_referral_percentage = values[Settings.DIRECT_REFERRAL_PERCENTAGE] / 100
+    referral_bonus_count = int(values[Settings.REFERRAL_BONUS_COUNT])
+    franchise_commission_percentage = values[Settings.FRANCHISE_COMMISSION_PERCENTAGE] / 100
+    penalty_weak = values[Settings.FLUSH_OUT_PENALTY_PERCENTAGE_WEAK] / 100
+    penalty_strong = values[Settings.FLUSH_OUT_PENALTY_PERCENTAGE_STRONG] / 100
+    fifth_pair_percentage = values[Settings.FIFTH_PAIR_PERCENTAGE] / 100
+
+    limits = snapshot.flush_out_limits.copy()
+    for package_id, flush_out_limit in (flush_out_limits or {}).items():
+        limits[snapshot.package_positions[int(package_id)]] = float(flush_out_limit)
+
+    simulation = PayoutSimulation(snapshot)
+    payouts = simulation.payouts
+    accounts = len(snapshot.account_ids)
+    left_wallets = np.zeros(accounts)
+    right_wallets = np.zeros(accounts)
+    sales_match_points_today = np.zeros(accounts)
+    matched_pv = np.zeros(accounts)
+    paid_fifth_pairs = np.zeros(accounts)
+    packages = snapshot.packages.copy()
+    counted_referrals = np.zeros(accounts, dtype=bool)
+    referral_counts = defaultdict(int)
+    current_date = None
+
+    for date, event_type, position, package, code_type in snapshot.events:
+        is_recorded = (start is None or date >= start) and (end is None or date < end)
+        if date != current_date:
+            current_date = date
+            sales_match_points_today[:] = 0
+
+        if event_type:
+            if position >= 0 and is_recorded:
+                payouts[ActivityType.FRANCHISE_COMMISSION][position] += (
+                    snapshot.package_amounts[package] * franchise_commission_percentage
+                )
+            continue
+
+        sponsor = snapshot.referrers[position]
+        if sponsor >= 0:
+            if counted_referrals[position]:
+                referral_counts[(sponsor, packages[position])] -= 1
+            if code_type != CodeType.FREE_SLOT:
+                referral_counts[(sponsor, package)] += 1
+                counted_referrals[position] = True
+        packages[position] = package
+
+        if sponsor >= 0:
+            if code_type == CodeType.FREE_SLOT:
+                continue
+
+            if is_recorded:
+                payouts[ActivityType.DIRECT_REFERRAL][sponsor] += (
+                    snapshot.package_amounts[package] * direct_referral_percentage
+                )
+                if (
+                    referral_counts[(sponsor, package)] % referral_bonus_count == 0
+                    and snapshot.has_referral_bonus[packages[sponsor], package]
+                ):
+                    payouts[ActivityType.REFERRAL_BONUS][sponsor] += (
+                        snapshot.referral_bonuses[packages[sponsor], package] * pv_conversion
+                    )
+
+        upline, left_sides = snapshot.get_upline(position)
+        if not len(upline):
+            continue
+
+        point_value = snapshot.point_values[package]
+        left_wallets[upline[left_sides]] += point_value
+        right_wallets[upline[~left_sides]] += point_value
+
+        upline_left_wallets = left_wallets[upline]
+        upline_right_wallets = right_wallets[upline]
+        strong_sides = get_strong_sides(upline_left_wallets, upline_right_wallets, left_sides)
+        strong_wallets = np.where(strong_sides, upline_left_wallets, upline_right_wallets)
+        weak_wallets = np.where(strong_sides, upline_right_wallets, upline_left_wallets)
+
+        is_matching = (strong_wallets > 0) & (weak_wallets > 0)
+        sales_match_pv = np.where(strong_wallets > weak_wallets, weak_wallets, point_value)
+        remaining_points_today = limits[packages[upline]] - sales_match_points_today[upline]
+        is_within_limit = remaining_points_today - sales_match_pv >= 0
+        matches = np.where(is_within_limit, sales_match_pv, np.maximum(remaining_points_today, 0)) * is_matching
+
+        has_match = matches > 0
+        matched = upline[has_match]
+        match_pv = matches[has_match]
+        if len(matched):
+            sales_match_points_today[matched] += match_pv
+            matched_pv[matched] += match_pv
+            left_wallets[matched] -= match_pv
+            right_wallets[matched] -= match_pv
+
+            if fifth_pair_percentage:
+                unpaid_pv = matched_pv[matched] - paid_fifth_pairs[matched] / pv_conversion / fifth_pair_percentage
+                fifth_pairs = (unpaid_pv - unpaid_pv % 100) * fifth_pair_percentage * pv_conversion
+            else:
+                fifth_pairs = np.zeros(len(matched))
+            paid_fifth_pairs[matched] += fifth_pairs
+            sales_matches = match_pv * pv_conversion - fifth_pairs
+            is_paid = sales_matches > 0
+
+            if is_recorded:
+                payouts[ActivityType.FIFTH_PAIR][matched] += fifth_pairs
+                payouts[ActivityType.SALES_MATCH][matched[is_paid]] += sales_matches[is_paid]
+
+                sponsors = matched[is_paid]
+                leadership_pv = match_pv[is_paid] * pv_conversion
+                for level in range(1, snapshot.leadership_levels + 1):
+                    sponsors = snapshot.get_sponsors(sponsors)
+                    has_sponsor = sponsors >= 0
+                    percentages = snapshot.leadership_percentages[packages[sponsors[has_sponsor]], level] / 100
+                    np.add.at(
+                        payouts[ActivityType.LEADERSHIP_BONUS],
+                        sponsors[has_sponsor],
+                        leadership_pv[has_sponsor] * percentages,
+                    )
+
+        is_flushing = is_matching & ~is_within_limit
+        flushed = upline[is_flushing]
+        if len(flushed):
+            flushed_left_wallets = left_wallets[flushed]
+            flushed_right_wallets = right_wallets[flushed]
+            strong_sides = get_strong_sides(flushed_left_wallets, flushed_right_wallets, left_sides[is_flushing])
+            strong_penalties = -np.abs(
+                np.where(strong_sides, flushed_left_wallets, flushed_right_wallets) * penalty_strong
+            )
+            weak_penalties = -np.abs(np.where(strong_sides, flushed_right_wallets, flushed_left_wallets) * penalty_weak)
+            left_wallets[flushed] += np.where(strong_sides, strong_penalties, weak_penalties)
+            right_wallets[flushed] += np.where(strong_sides, weak_penalties, strong_penalties)
+            if is_recorded:
+                simulation.flush_outs[flushed] -= strong_penalties + weak_penalties
+
+    return simulation
+
+
+def compare_payouts(settings=None, flush_out_limits=None, start=None, end=None, limit=10, snapshot=None):
+    if snapshot is None:
+        snapshot = TreeSnapshot()
+
+    baseline = simulate_payouts(snapshot, start=start, end=end)
+    candidate = simulate_payouts(snapshot, settings, flush_out_limits, start, end)
+    baseline_totals = baseline.get_totals()
+    candidate_totals = candidate.get_totals()
+
+    changes = candidate.get_account_payouts() - baseline.get_account_payouts()
+    positions = np.argsort(-np.abs(changes), kind="stable")[:limit]
+    return {
+        "baseline": baseline_totals,
+        "candidate": candidate_totals,
+        "baseline_total": round(sum(baseline_totals.values()), 2),
+        "candidate_total": round(sum(candidate_totals.values()), 2),
+        "flush_outs": {
+            "baseline": round(float(baseline.flush_outs.sum()), 2),
+            "candidate": round(float(candidate.flush_outs.sum()), 2),
+        },
+        "top_changes": [
+            {"account": int(snapshot.account_ids[position]), "change": round(float(changes[position]), 2)}
+            for position in positions
+            if changes[position]
+        ],
+    }
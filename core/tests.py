@@ -0,0 +1,54 @@
+import decimal
+from django.test import TestCase
+from accounts.models import Account
+from core.enums import ActivityStatus, ActivityType, WalletType
+from core.models import Activity, PointValueBalance, quantize_activity_amount
+from core.services import CompPlanBatch
+
+
+class HalfCentFlushOutTest(TestCase):
+    fixtures = ["settings.json"]
+
+    # Half of a strong side of 24.37 PV
+    penalty = -12.185
+
+    def create_account(self):
+        return Account.objects.create(first_name="Member", last_name="Test")
+
+    def get_balance(self, account=None):
+        return PointValueBalance.objects.get(account=account, wallet=WalletType.PV_LEFT_WALLET)
+
+    def test_rounds_half_away_from_zero(self):
+        self.assertEqual(quantize_activity_amount(self.penalty), decimal.Decimal("-12.19"))
+        self.assertEqual(quantize_activity_amount("0.005"), decimal.Decimal("0.01"))
+
+    def test_batched_and_per_row_flush_outs_match_the_ledger(self):
+        per_row_account = self.create_account()
+        Activity.objects.create(
+            account=per_row_account,
+            activity_type=ActivityType.FLUSH_OUT_PENALTY,
+            activity_amount=self.penalty,
+            status=ActivityStatus.DONE,
+            wallet=WalletType.PV_LEFT_WALLET,
+        )
+
+        batched_account = self.create_account()
+        batch = CompPlanBatch()
+        batch.create_activity(
+            account=batched_account,
+            activity_type=ActivityType.FLUSH_OUT_PENALTY,
+            activity_amount=self.penalty,
+            status=ActivityStatus.DONE,
+            wallet=WalletType.PV_LEFT_WALLET,
+        )
+        batch.save()
+
+        for account in [per_row_account, batched_account]:
+            activity = Activity.objects.get(account=account)
+            balance = self.get_balance(account)
+            self.assertEqual(activity.activity_amount, decimal.Decimal("-12.19"))
+            self.assertEqual(balance.balance, activity.activity_amount)
+            self.assertEqual(balance.flushout_total, activity.activity_amount)
+        self.assertEqual(
+            batch.pv_wallet_totals[(batched_account.pk, WalletType.PV_LEFT_WALLET)], decimal.Decimal("-12.19")
+        )
@@ -1,10 +1,13 @@
 from rest_framework.routers import DefaultRouter
 from django.urls import path
 from core.api import (
+    ActivityTimeSeriesView,
     CashoutMethodView,
+    CompPlanJobStatusView,
     CreateFranchiseeView,
     FranchiseeListViewSet,
     SettingsViewSet,
+    SimulatePayoutsView,
     PackagesViewSet,
     ReferralBonusesViewSet,
     LeadershipBonusesViewSet,
@@ -76,7 +79,9 @@ urlpatterns = [
     path("getallactivitytotalamount/", SummaryActivityAmountAdminView.as_view()),
     path("getcompanywalletsummary/", SummaryWalletAdminView.as_view()),
     path("getallpvwalletsummary/", SummaryPVWalletAdminView.as_view()),
+    path("getactivitytimeseries/", ActivityTimeSeriesView.as_view()),
     path("updatecashoutstatus/", UpdateCashoutStatusView.as_view()),
+    path("simulatepayouts/", SimulatePayoutsView.as_view()),
     # Member
     path("getactivitystats/", SummaryActivityStatsMemberView.as_view()),
     path("getactivitysummaryinfo/", SummaryMemberView.as_view()),
@@ -95,6 +100,8 @@ urlpatterns = [
     # franchisee
     path("verifyfranchisecode/", VerifyFranchiseeCodeView.as_view()),
     path("createfranchisee/", CreateFranchiseeView.as_view()),
+    # comp plan jobs
+    path("getcompplanjobstatus/", CompPlanJobStatusView.as_view()),
 ]
 
 
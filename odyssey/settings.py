@@ -263,11 +263,54 @@ MEDIA_URL = "/media/"
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
+# Genealogy levels loaded below the requested account, and the most a client may ask for
+GENEALOGY_DEPTH = 5
+GENEALOGY_MAX_DEPTH = 10
+GENEALOGY_CHUNK_SIZE = 2000
+
+# Top earners returned by default, and the most a client may ask for
+LEADERBOARD_SIZE = 5
+LEADERBOARD_MAX_SIZE = 100
+
+# Computes each registration's comp plan in memory and writes its activities with bulk_create
+COMP_PLAN_BATCHED = True
+# Comp plans lock the point value balances of their whole upline until commit. They only run in parallel in separate
+# genealogy trees; every signup under the company root waits for the one before it.
+# Attempts of a comp plan that hit a serialization failure or deadlock, sleeping up to this many seconds times the
+# attempt number in between
+COMP_PLAN_LOCK_ATTEMPTS = 3
+COMP_PLAN_LOCK_RETRY_DELAY = 0.1
+
+# Seconds a process trusts its settings and comp plan rule snapshots before comparing their table versions
+SNAPSHOT_TIMEOUT = 1
+
+# Queues comp plans of new and upgraded accounts for the process_comp_plan_jobs worker instead of running them
+# inside the request. Jobs of one genealogy tree run one batch at a time, and every account hangs under the single
+# company root, so one worker process is all the queue can use
+COMP_PLAN_ASYNC = False
+COMP_PLAN_JOB_MAX_ATTEMPTS = 3
+# Seconds before a failed job is retried, multiplied by its attempts so far
+COMP_PLAN_JOB_RETRY_DELAY = 30
+# Seconds after which a running job is assumed to belong to a dead worker and is claimed again
+COMP_PLAN_JOB_TIMEOUT = 600
+# Jobs of one tree queued within this many seconds of its oldest open job are applied together, up to the batch size
+COMP_PLAN_JOB_COALESCE_WINDOW = 2
+COMP_PLAN_JOB_BATCH_SIZE = 50
+
+# Results the run_benchmarks command compares against, written by run_benchmarks --save
+BENCHMARK_BASELINE = Path(BASE_DIR, "benchmarks.json")
+
 
 CRON_CLASSES = [
     "vanguard.cron.DeleteBlacklistedTokens",
     "vanguard.cron.DeleteOutstandingTokens",
+    "vanguard.cron.RollupDailyActivities",
 ]
+# Rolled up days the activity rollup cron computes again on every run
+ACTIVITY_ROLLUP_LOOKBACK_DAYS = 2
+# Days an activity time series covers by default and at most
+TIME_SERIES_DEFAULT_DAYS = 30
+TIME_SERIES_MAX_DAYS = 731
 
 
 EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
@@ -4,6 +4,7 @@ from django.db.models import Q
 import datetime
 from tzlocal import get_localzone
 from django.utils import timezone
+from core.services import rollup_daily_activities
 
 
 class DeleteBlacklistedTokens(CronJobBase):
@@ -28,3 +29,13 @@ class DeleteOutstandingTokens(CronJobBase):
         local_tz = get_localzone()
         date_today = datetime.datetime.now().astimezone(local_tz)
         OutstandingToken.objects.filter(Q(user__isnull=True) | Q(expires_at__lt=date_today)).delete()
+
+
+class RollupDailyActivities(CronJobBase):
+    RUN_EVERY_MINS = 60
+    RETRY_AFTER_FAILURE_MINS = 5
+    schedule = Schedule(run_every_mins=RUN_EVERY_MINS, retry_after_failure_mins=RETRY_AFTER_FAILURE_MINS)
+    code = "vanguard.rollup_daily_activities"
+
+    def do(self):
+        return "Rolled up %s activity groups." % rollup_daily_activities()